@@ -0,0 +1,845 @@
+"""
+Benchmarks for the chat server.
+
+   python bench.py frames [--clients 10,100,1000] [--sizes 16,256,4096] [--rounds N]
+   python bench.py xor [--sizes 10,...,1048576] [--rounds N]
+   python bench.py wire [--sizes 16,256,4096] [--messages N] [--rounds N]
+   python bench.py deflate [--clients 10,100] [--sizes 1024,16384,262144] [--rounds N]
+   python bench.py load [--target server|serv] [--clients 10,100,1000,10000] [--workers 1,2,4] [--processes N] [--rate N] [--output FILE]
+   python bench.py startup [--rounds N] [--output FILE]
+   python bench.py memory [--clients 1000,10000] [--room-size N] [--output FILE]
+   python bench.py storm [--clients 100,1000] [--intervals 0,0.5] [--output FILE]
+"""
+import argparse
+import array
+import asyncio
+import base64
+import datetime
+import importlib
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import zlib
+import time
+
+import uvicorn
+import websockets
+from websockets.protocol import State
+from websockets.server import ServerProtocol
+
+# Every load client shares 127.0.0.1 and sends on a schedule, so the server's
+# abuse limits would only measure themselves. Set before server is imported,
+# here and in the load command's server process.
+for name in ("CHAT_RATE_MESSAGES", "CHAT_IP_RATE_MESSAGES", "CHAT_MAX_CONNECTIONS"):
+    os.environ.setdefault(name, "0")
+
+import server
+
+
+def parse_list(text):
+    return [int(x) for x in text.split(",") if x]
+
+
+def best_of(fn, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+# -------------------- frames --------------------
+
+def open_connection():
+    conn = ServerProtocol()
+    conn.state = State.OPEN
+    return conn
+
+
+def bench_frames(args):
+    """
+    Per-recipient send_text() framing (what uvicorn does for every
+    websocket.send) against server.encode_text_frame() once per broadcast.
+    """
+    print(f"{'clients':>8} {'bytes':>6} {'per-client us':>14} {'encode-once us':>15} {'speedup':>8}")
+    for clients in parse_list(args.clients):
+        conns = [open_connection() for _ in range(clients)]
+        for size in parse_list(args.sizes):
+            message = "0:" + "x" * (size - 2)
+            written = []
+            write = written.append
+
+            def per_client():
+                for conn in conns:
+                    conn.send_text(message.encode())
+                    write(b"".join(conn.data_to_send()))
+                written.clear()
+
+            def encode_once():
+                frame = server.encode_text_frame(message)
+                for _ in conns:
+                    write(frame)
+                written.clear()
+
+            old = best_of(per_client, args.rounds) * 1e6
+            new = best_of(encode_once, args.rounds) * 1e6
+            print(f"{clients:>8} {size:>6} {old:>14.1f} {new:>15.1f} {old / new:>7.1f}x")
+
+
+# -------------------- xor --------------------
+
+def reference_encrypt(message, key):
+    # serv.encrypt_message as it was before the keystream cache
+    key_len = len(key)
+    encrypted_bytes = bytes([b ^ ord(key[i % key_len]) for i, b in enumerate(message.encode())])
+    return base64.b64encode(encrypted_bytes).decode()
+
+
+def bench_xor(args):
+    """
+    serv.encrypt_message's per-byte list comprehension against the bulk
+    keystream XOR, on the big-int path and (if installed) the NumPy path.
+    """
+    import serv
+
+    key = serv.ENCRYPTION_KEY
+    numpy = serv.numpy
+    print(f"{'bytes':>8} {'per-byte us':>12} {'big-int us':>11} {'numpy us':>9} {'speedup':>8}")
+    for size in parse_list(args.sizes):
+        message = ("0123456789abcdef" * (size // 16 + 1))[:size]
+        expected = reference_encrypt(message, key)
+        rounds = max(3, min(args.rounds, 10_000_000 // max(size, 1)))
+
+        serv.numpy = None
+        assert serv.encrypt_message(message, key) == expected
+        bigint = best_of(lambda: serv.encrypt_message(message, key), rounds) * 1e6
+        vectorized = float("nan")
+        if numpy is not None:
+            serv.numpy = numpy
+            serv.NUMPY_XOR_MIN_BYTES, threshold = 0, serv.NUMPY_XOR_MIN_BYTES
+            assert serv.encrypt_message(message, key) == expected
+            vectorized = best_of(lambda: serv.encrypt_message(message, key), rounds) * 1e6
+            serv.NUMPY_XOR_MIN_BYTES = threshold
+        serv.numpy = numpy
+
+        old = best_of(lambda: reference_encrypt(message, key), max(3, rounds // 10)) * 1e6
+        best = min(bigint, vectorized) if numpy is not None else bigint
+        print(f"{size:>8} {old:>12.1f} {bigint:>11.1f} {vectorized:>9.1f} {old / best:>7.1f}x")
+
+
+# -------------------- wire --------------------
+
+def bench_wire(args):
+    """
+    Bytes on the wire and client-side parse time for a batch of sequenced
+    messages: {"seq", "msg"} JSON records against chat.binary.v1 packets.
+    """
+    print(f"{'bytes':>6} {'json B/msg':>11} {'binary B/msg':>13} {'json parse us':>14} {'binary parse us':>16} {'speedup':>8}")
+    count = args.messages
+    for size in parse_list(args.sizes):
+        text = "x" * size
+        records = [
+            server.encode_record(seq, f"3:{text}", server.KIND_TEXT, 4)
+            for seq in range(1, count + 1)
+        ]
+        json_frame = b'{"batch": [' + b",".join(records) + b"]}"
+        binary_frame = b"".join(
+            server.encode_packet(server.KIND_TEXT, 4, seq, text) for seq in range(1, count + 1)
+        )
+
+        def parse_json():
+            for entry in json.loads(json_frame)["batch"]:
+                entry["msg"].split(":", 1)
+
+        def parse_binary():
+            server.unpack_packets(binary_frame)
+
+        old = best_of(parse_json, args.rounds) * 1e6
+        new = best_of(parse_binary, args.rounds) * 1e6
+        print(
+            f"{size:>6} {len(json_frame) / count:>11.1f} {len(binary_frame) / count:>13.1f}"
+            f" {old:>14.1f} {new:>16.1f} {old / new:>7.1f}x"
+        )
+
+
+# -------------------- deflate --------------------
+
+def bench_deflate(args):
+    """
+    permessage-deflate cost per broadcast: compressing for every recipient
+    (context takeover) against compressing once and sharing the frame.
+    """
+    bits = server.COMPRESSION_WINDOW_BITS
+    print(f"{'clients':>8} {'bytes':>7} {'ratio':>6} {'per-client us':>14} {'shared us':>10} {'speedup':>8}")
+    for clients in parse_list(args.clients):
+        for size in parse_list(args.sizes):
+            line = "2024-05-01 12:00:00 INFO worker-%d handled request in %d ms\n"
+            text = "".join(line % (i % 7, i % 250) for i in range(size // 40 + 1))[:size]
+            frame = server.encode_text_frame(text)
+            compressors = [
+                zlib.compressobj(server.COMPRESSION_LEVEL, zlib.DEFLATED, -bits, server.COMPRESSION_MEM_LEVEL)
+                for _ in range(clients)
+            ]
+
+            def per_client():
+                for compressor in compressors:
+                    server.Deflater(bits, compressor).compress_frame(frame)
+
+            def shared():
+                server.shared_frame(frame, server.Deflater(bits), {})
+
+            ratio = len(server.Deflater(bits).compress_frame(frame)) / len(frame)
+            old = best_of(per_client, args.rounds) * 1e6
+            new = best_of(shared, args.rounds) * 1e6
+            print(f"{clients:>8} {size:>7} {ratio:>6.3f} {old:>14.1f} {new:>10.1f} {old / new:>7.1f}x")
+
+
+# -------------------- load --------------------
+
+def raise_open_files_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def serve(target, port, workers=1):
+    # Runs in a child process so the server never shares a loop or a CPU with the load
+    raise_open_files_limit()
+    module = importlib.import_module(target)
+    if workers > 1:
+        module.run_workers(workers, "127.0.0.1", port)
+    else:
+        uvicorn.run(module.app, host="127.0.0.1", port=port, log_level="warning", ws=module.FrameWriterProtocol)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=15.0, poll=0.05):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(poll)
+    raise RuntimeError(f"server did not start listening on port {port}")
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+class LoadRun:
+    """
+    One load process's share of a load level: every client receives, the first
+    `senders` also send "bench:<sender>:<seq>:<perf_counter_ns>:" messages at an
+    aggregate `rate`. With several load processes, `barrier` lines up their
+    send phases and `total_sent` adds up what all of them sent.
+    """
+    def __init__(self, uri, decode, clients, senders, rate, size, duration, name="0", barrier=None, total_sent=None):
+        self.uri = uri
+        self.decode = decode
+        self.clients = clients
+        self.senders = min(senders, clients)
+        self.rate = rate
+        self.size = size
+        self.duration = duration
+        self.name = name
+        self.barrier = barrier
+        self.total_sent = total_sent
+        self.sent = 0
+        self.delivered = 0
+        self.reordered = 0
+        self.latencies = array.array("d")
+        self.last_seq = {}  # (receiver, sender) -> last seq seen
+
+    async def connect(self, limit=200):
+        gate = asyncio.Semaphore(limit)
+
+        async def open_one():
+            async with gate:
+                return await websockets.connect(self.uri, compression=None, max_queue=None, open_timeout=60)
+
+        return await asyncio.gather(*(open_one() for _ in range(self.clients)))
+
+    async def receive(self, receiver, websocket):
+        try:
+            async for frame in websocket:
+                received = time.perf_counter_ns()
+                text = self.decode(frame)
+                if not text.startswith("bench:"):
+                    continue
+                _, sender, seq, sent, _ = text.split(":", 4)
+                key = (receiver, sender)
+                seq = int(seq)
+                if seq <= self.last_seq.get(key, 0):
+                    self.reordered += 1
+                self.last_seq[key] = max(seq, self.last_seq.get(key, 0))
+                self.delivered += 1
+                self.latencies.append((received - int(sent)) / 1e6)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def send(self, sender, websocket):
+        interval = self.senders / self.rate
+        padding = "x" * self.size
+        next_send = time.perf_counter()
+        stop = next_send + self.duration
+        seq = 0
+        while next_send < stop:
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            seq += 1
+            await websocket.send(f"bench:{self.name}.{sender}:{seq}:{time.perf_counter_ns()}:{padding}")
+            self.sent += 1
+            next_send += interval
+
+    async def run(self, settle=0.5, drain=5.0):
+        start = time.perf_counter()
+        sockets = await self.connect()
+        connect_seconds = time.perf_counter() - start
+        receivers = [asyncio.create_task(self.receive(i, ws)) for i, ws in enumerate(sockets)]
+        await asyncio.sleep(settle)  # let the join broadcasts pass
+        self.delivered = 0
+        del self.latencies[:]
+
+        if self.barrier is not None:
+            await asyncio.to_thread(self.barrier.wait)
+        start = time.perf_counter()
+        await asyncio.gather(*(self.send(i, sockets[i]) for i in range(self.senders)))
+        sent = self.sent
+        if self.total_sent is not None:
+            with self.total_sent.get_lock():
+                self.total_sent.value += self.sent
+            await asyncio.to_thread(self.barrier.wait)
+            sent = self.total_sent.value
+        expected = sent * self.clients - self.sent  # every message reaches all but its sender
+        deadline = time.perf_counter() + drain
+        while self.delivered < expected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - start
+
+        await asyncio.gather(*(ws.close() for ws in sockets), return_exceptions=True)
+        for task in receivers:
+            task.cancel()
+        return {
+            "connect_seconds": connect_seconds,
+            "sent": self.sent,
+            "expected": expected,
+            "delivered": self.delivered,
+            "reordered": self.reordered,
+            "elapsed": elapsed,
+            "latencies": self.latencies.tolist(),
+        }
+
+
+def share(total, parts, index):
+    return total // parts + (1 if index < total % parts else 0)
+
+
+def load_process(target, uri, index, processes, args, clients, barrier, total_sent, results):
+    # One of --processes load generators, each with its share of the clients and senders
+    raise_open_files_limit()
+    senders = share(args.senders, processes, index)
+    rate = args.rate * senders / args.senders
+    run = LoadRun(
+        uri, load_decoder(target), share(clients, processes, index), senders, rate, args.size, args.duration,
+        name=str(index), barrier=barrier, total_sent=total_sent,
+    )
+    results.put(asyncio.run(run.run()))
+
+
+def run_load_level(args, uri, clients, workers):
+    """Runs one load level over --processes load processes and merges their results."""
+    if args.processes == 1:
+        parts = [asyncio.run(LoadRun(
+            uri, load_decoder(args.target), clients, args.senders, args.rate, args.size, args.duration,
+        ).run())]
+    else:
+        context = multiprocessing.get_context("spawn")
+        barrier = context.Barrier(args.processes)
+        total_sent = context.Value("q", 0)
+        results = context.Queue()
+        processes = [
+            context.Process(
+                target=load_process,
+                args=(args.target, uri, i, args.processes, args, clients, barrier, total_sent, results),
+            )
+            for i in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        parts = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+    latencies = sorted(itertools.chain.from_iterable(part["latencies"] for part in parts))
+    sent = sum(part["sent"] for part in parts)
+    expected = sum(part["expected"] for part in parts)
+    delivered = sum(part["delivered"] for part in parts)
+    elapsed = max(part["elapsed"] for part in parts)
+    return {
+        "clients": clients,
+        "workers": workers,
+        "processes": args.processes,
+        "senders": min(args.senders, clients),
+        "rate": args.rate,
+        "size": args.size,
+        "duration": args.duration,
+        "connect_seconds": round(max(part["connect_seconds"] for part in parts), 3),
+        "sent": sent,
+        "expected": expected,
+        "delivered": delivered,
+        "delivery_ratio": round(delivered / expected, 4) if expected else None,
+        "reordered": sum(part["reordered"] for part in parts),
+        "deliveries_per_second": round(delivered / elapsed, 1),
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1] if latencies else None,
+        },
+    }
+
+
+def load_decoder(target):
+    if target == "serv":
+        import serv
+        return lambda frame: serv.decrypt_message(frame.partition(":")[2])
+    return lambda frame: frame.partition(":")[2]
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_load(args):
+    """
+    For every --workers count, starts the target's app on localhost in a child
+    process (forking that many SO_REUSEPORT workers), then for every client
+    count opens that many websockets from --processes load processes, drives
+    --rate messages per second through --senders of them and measures delivery
+    and end-to-end fan-out latency. Results go to --output as JSON.
+    """
+    raise_open_files_limit()
+    if args.target == "serv" and parse_list(args.workers) != [1]:
+        raise SystemExit("only server.py has a --workers mode")
+    results = {
+        "target": args.target,
+        "revision": git_revision(),
+        "started": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "runs": [],
+    }
+    print(
+        f"{'workers':>7} {'clients':>8} {'sent':>7} {'delivered':>10} {'ratio':>6} {'deliv/s':>10}"
+        f" {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    )
+    for workers in parse_list(args.workers):
+        port = free_port()
+        server_process = multiprocessing.get_context("spawn").Process(
+            target=serve, args=(args.target, port, workers), daemon=True,
+        )
+        server_process.start()
+        try:
+            wait_for_port(port)
+            if workers > 1:
+                time.sleep(1.0)  # the port opens with the first worker, let the others start listening too
+            for clients in parse_list(args.clients):
+                result = run_load_level(args, f"ws://127.0.0.1:{port}/ws", clients, workers)
+                results["runs"].append(result)
+                latency = result["latency_ms"]
+                print(
+                    f"{workers:>7} {clients:>8} {result['sent']:>7} {result['delivered']:>10}"
+                    f" {result['delivery_ratio'] or 0:>6.3f} {result['deliveries_per_second']:>10.0f}"
+                    f" {latency['p50'] or 0:>8.2f} {latency['p95'] or 0:>8.2f} {latency['p99'] or 0:>8.2f}"
+                )
+        finally:
+            server_process.terminate()
+            server_process.join()
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def median(samples):
+    samples = sorted(samples)
+    return samples[len(samples) // 2]
+
+
+def interpreter_run(code):
+    """Seconds a fresh interpreter takes to run code, and its output."""
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd=HERE).stdout
+    return time.perf_counter() - start, output
+
+
+async def wait_for_join(uri, start, timeout=30.0):
+    """
+    Seconds from start until someone else joins uri's room. The socket asks
+    for a replay, so a join that happened before it connected still counts.
+    """
+    async with websockets.connect(uri + "?last=100") as websocket:
+        deadline = time.perf_counter() + timeout
+        own_id = None
+        while True:
+            frame = json.loads(await asyncio.wait_for(websocket.recv(), deadline - time.perf_counter()))
+            own_id = frame.get("user") if "session" in frame else own_id
+            for record in frame.get("batch", [frame]):
+                if record.get("event") == "join" and record.get("user") != own_id:
+                    return time.perf_counter() - start
+
+
+def launch(argv, answers):
+    """Starts a chat process with its prompts answered; stdin stays open so it keeps running."""
+    process = subprocess.Popen(
+        [sys.executable, *argv], cwd=HERE, stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    process.stdin.write("".join(f"{answer}\n" for answer in answers).encode())
+    process.stdin.flush()
+    return process
+
+
+def stop(process):
+    process.terminate()
+    try:
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def bench_startup(args):
+    """
+    Cold-start costs, each the median of --rounds fresh interpreters:
+    importing terminal.py and server.py (less an empty interpreter, plus
+    the number of modules loaded), `server.py --terminal` from launch until
+    its join reaches an already running server, and `server.py` from launch
+    until it listens and until its embedded client has joined.
+    """
+    results = {
+        "revision": git_revision(),
+        "started": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "rounds": args.rounds,
+    }
+    # Joins are timed, so the servers started here send them at once instead
+    # of in a presence digest up to an interval later
+    os.environ["CHAT_PRESENCE_INTERVAL"] = "0"
+    baseline = median(interpreter_run("pass")[0] for _ in range(args.rounds))
+    print(f"{'':<24} {'median ms':>10}")
+    print(f"{'empty interpreter':<24} {baseline * 1000:>10.1f}")
+    for module in ("terminal", "server"):
+        runs = [interpreter_run(f"import sys, {module}; print(len(sys.modules))") for _ in range(args.rounds)]
+        seconds = median(seconds for seconds, _ in runs) - baseline
+        results[f"import_{module}"] = {"ms": seconds * 1000, "modules": int(runs[0][1].split()[-1])}
+        print(f"{'import ' + module:<24} {seconds * 1000:>10.1f}   {results[f'import_{module}']['modules']} modules")
+
+    port = free_port()
+    server_process = multiprocessing.get_context("spawn").Process(target=serve, args=("server", port), daemon=True)
+    server_process.start()
+    try:
+        wait_for_port(port)
+        joins = []
+        for i in range(args.rounds):
+            room = f"startup-terminal-{i}"
+            start = time.perf_counter()
+            client = launch(["server.py", "--terminal"], ["127.0.0.1", port, room])
+            try:
+                joins.append(asyncio.run(wait_for_join(f"ws://127.0.0.1:{port}/ws/{room}", start)))
+            finally:
+                stop(client)
+    finally:
+        server_process.terminate()
+        server_process.join()
+    results["terminal_join_ms"] = median(joins) * 1000
+    print(f"{'--terminal joined':<24} {results['terminal_join_ms']:>10.1f}")
+
+    listening, joins = [], []
+    for i in range(args.rounds):
+        port = free_port()
+        start = time.perf_counter()
+        server_process = launch(["server.py"], [port, "startup"])
+        try:
+            wait_for_port(port, poll=0.002)
+            listening.append(time.perf_counter() - start)
+            joins.append(asyncio.run(wait_for_join(f"ws://127.0.0.1:{port}/ws/startup", start)))
+        finally:
+            stop(server_process)
+    results["server_listening_ms"] = median(listening) * 1000
+    results["server_join_ms"] = median(joins) * 1000
+    print(f"{'server listening':<24} {results['server_listening_ms']:>10.1f}")
+    print(f"{'server client joined':<24} {results['server_join_ms']:>10.1f}")
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+# -------------------- memory --------------------
+
+def resident_bytes(pid):
+    # Linux only: VmRSS of a running process
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError(f"no VmRSS for pid {pid}")
+
+
+def cpu_seconds(pid):
+    # Linux only: user and system time a running process has used
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rpartition(")")[2].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def hold_idle_clients(port, clients, room_size, pid, settle=2.0, limit=200):
+    """
+    Opens clients idle websockets, room_size to a room so their joins do not
+    fan out to everyone, and returns the server's resident bytes while they
+    are all connected.
+    """
+    gate = asyncio.Semaphore(limit)
+
+    async def open_one(i):
+        async with gate:
+            uri = f"ws://127.0.0.1:{port}/ws/idle-{i // room_size}"
+            return await websockets.connect(uri, compression=None, max_queue=None, open_timeout=60)
+
+    sockets = await asyncio.gather(*(open_one(i) for i in range(clients)))
+    try:
+        await asyncio.sleep(settle)
+        return resident_bytes(pid)
+    finally:
+        await asyncio.gather(*(ws.close() for ws in sockets), return_exceptions=True)
+
+
+def bench_memory(args):
+    """
+    Server memory per idle connection: for every client count, starts a fresh
+    server in a child process, warms it up with one connection per room, then
+    measures its resident set with that many idle clients connected on top.
+    """
+    if not os.path.exists(f"/proc/{os.getpid()}/status"):
+        raise SystemExit("the memory benchmark reads /proc and needs Linux")
+    raise_open_files_limit()
+    results = {
+        "revision": git_revision(),
+        "started": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "room_size": args.room_size,
+        "runs": [],
+    }
+    print(f"{'clients':>8} {'baseline MiB':>13} {'loaded MiB':>11} {'per conn KiB':>13} {'per GiB':>9}")
+    for clients in parse_list(args.clients):
+        port = free_port()
+        server_process = multiprocessing.get_context("spawn").Process(
+            target=serve, args=("server", port), daemon=True,
+        )
+        server_process.start()
+        try:
+            wait_for_port(port)
+            rooms = -(-clients // args.room_size)
+            # Rooms, histories and lazily imported modules are not per-connection costs
+            baseline = asyncio.run(hold_idle_clients(port, rooms, 1, server_process.pid))
+            loaded = asyncio.run(hold_idle_clients(port, clients, args.room_size, server_process.pid))
+        finally:
+            server_process.terminate()
+            server_process.join()
+        per_connection = max(loaded - baseline, 0) / clients
+        result = {
+            "clients": clients,
+            "baseline_bytes": baseline,
+            "loaded_bytes": loaded,
+            "bytes_per_connection": round(per_connection),
+            "connections_per_gib": int(2 ** 30 / per_connection) if per_connection else None,
+        }
+        results["runs"].append(result)
+        print(
+            f"{clients:>8} {baseline / 2 ** 20:>13.1f} {loaded / 2 ** 20:>11.1f}"
+            f" {per_connection / 1024:>13.1f} {result['connections_per_gib'] or 0:>9}"
+        )
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+# -------------------- storm --------------------
+
+async def connection_storm(port, clients, pid, quiet=1.0, limit=200):
+    """
+    Connects clients to one room at once and counts the frames and bytes
+    they are sent until the server has been quiet for quiet seconds, then
+    disconnects them all. Returns the counts and the server CPU time each
+    half of the storm cost.
+    """
+    gate = asyncio.Semaphore(limit)
+    received = {"frames": 0, "bytes": 0, "last": time.monotonic()}
+
+    async def listen(ws):
+        try:
+            async for frame in ws:
+                received["frames"] += 1
+                received["bytes"] += len(frame)
+                received["last"] = time.monotonic()
+        except websockets.ConnectionClosed:
+            pass
+
+    async def open_one():
+        async with gate:
+            ws = await websockets.connect(
+                f"ws://127.0.0.1:{port}/ws/storm", compression=None, max_queue=None, open_timeout=60,
+            )
+        return ws, asyncio.create_task(listen(ws))
+
+    cpu = cpu_seconds(pid)
+    start = time.monotonic()
+    opened = await asyncio.gather(*(open_one() for _ in range(clients)))
+    while time.monotonic() - received["last"] < quiet:
+        await asyncio.sleep(quiet / 10)
+    settled = received["last"] - start
+    join_cpu = cpu_seconds(pid) - cpu
+    cpu = cpu_seconds(pid)
+    await asyncio.gather(*(ws.close() for ws, _ in opened), return_exceptions=True)
+    await asyncio.gather(*(task for _, task in opened), return_exceptions=True)
+    await asyncio.sleep(quiet)
+    return {
+        "frames": received["frames"],
+        "bytes": received["bytes"],
+        "settled_seconds": round(settled, 3),
+        "join_cpu_seconds": round(join_cpu, 3),
+        "leave_cpu_seconds": round(cpu_seconds(pid) - cpu, 3),
+    }
+
+
+def bench_storm(args):
+    """
+    Cost of a connection storm with joins and leaves sent one by one
+    (interval 0) and coalesced into presence digests: for every interval
+    and client count, starts a fresh server, connects that many clients to
+    one room at once and disconnects them again.
+    """
+    if not os.path.exists(f"/proc/{os.getpid()}/stat"):
+        raise SystemExit("the storm benchmark reads /proc and needs Linux")
+    raise_open_files_limit()
+    results = {
+        "revision": git_revision(),
+        "started": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "runs": [],
+    }
+    print(f"{'interval':>8} {'clients':>8} {'frames':>9} {'KiB':>9} {'settled s':>10} {'join cpu s':>11} {'leave cpu s':>12}")
+    for interval in args.intervals.split(","):
+        for clients in parse_list(args.clients):
+            port = free_port()
+            # The spawned server reads its presence interval from the environment
+            os.environ["CHAT_PRESENCE_INTERVAL"] = interval
+            server_process = multiprocessing.get_context("spawn").Process(
+                target=serve, args=("server", port), daemon=True,
+            )
+            server_process.start()
+            try:
+                wait_for_port(port)
+                quiet = max(1.0, 2 * float(interval))
+                result = asyncio.run(connection_storm(port, clients, server_process.pid, quiet))
+            finally:
+                server_process.terminate()
+                server_process.join()
+            result = {"presence_interval": float(interval), "clients": clients, **result}
+            results["runs"].append(result)
+            print(
+                f"{interval:>8} {clients:>8} {result['frames']:>9} {result['bytes'] / 1024:>9.0f}"
+                f" {result['settled_seconds']:>10.2f} {result['join_cpu_seconds']:>11.2f}"
+                f" {result['leave_cpu_seconds']:>12.2f}"
+            )
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    frames = sub.add_parser("frames", help="per-recipient framing vs encode-once broadcast frames")
+    frames.add_argument("--clients", default="10,100,1000")
+    frames.add_argument("--sizes", default="16,256,4096")
+    frames.add_argument("--rounds", type=int, default=50)
+    frames.set_defaults(func=bench_frames)
+
+    xor = sub.add_parser("xor", help="serv.py per-byte XOR vs cached keystream bulk XOR")
+    xor.add_argument("--sizes", default="10,100,1024,10240,102400,1048576")
+    xor.add_argument("--rounds", type=int, default=1000)
+    xor.set_defaults(func=bench_xor)
+
+    wire = sub.add_parser("wire", help="JSON records vs binary packets: size and parse time")
+    wire.add_argument("--sizes", default="16,256,4096")
+    wire.add_argument("--messages", type=int, default=1000)
+    wire.add_argument("--rounds", type=int, default=20)
+    wire.set_defaults(func=bench_wire)
+
+    deflate = sub.add_parser("deflate", help="per-recipient vs shared permessage-deflate compression")
+    deflate.add_argument("--clients", default="10,100")
+    deflate.add_argument("--sizes", default="1024,16384,262144")
+    deflate.add_argument("--rounds", type=int, default=5)
+    deflate.set_defaults(func=bench_deflate)
+
+    load = sub.add_parser("load", help="N websocket clients against a local server: throughput and fan-out latency")
+    load.add_argument("--target", choices=("server", "serv"), default="server")
+    load.add_argument("--clients", default="10,100,1000,10000")
+    load.add_argument("--workers", default="1", help="server worker processes, e.g. 1,2,4 to compare")
+    load.add_argument("--processes", type=int, default=1, help="load generator processes the clients are spread over")
+    load.add_argument("--senders", type=int, default=1)
+    load.add_argument("--rate", type=float, default=20.0, help="messages per second across all senders")
+    load.add_argument("--size", type=int, default=64, help="padding bytes per message")
+    load.add_argument("--duration", type=float, default=5.0, help="seconds of sending per client count")
+    load.add_argument("--output", default="bench-load.json")
+    load.set_defaults(func=bench_load)
+
+    startup = sub.add_parser("startup", help="cold-start time of the terminal client and the server")
+    startup.add_argument("--rounds", type=int, default=5)
+    startup.add_argument("--output", default="bench-startup.json")
+    startup.set_defaults(func=bench_startup)
+
+    memory = sub.add_parser("memory", help="server resident memory per idle websocket connection")
+    memory.add_argument("--clients", default="1000,10000")
+    memory.add_argument("--room-size", type=int, default=100, help="idle clients per room")
+    memory.add_argument("--output", default="bench-memory.json")
+    memory.set_defaults(func=bench_memory)
+
+    storm = sub.add_parser("storm", help="server cost of many clients joining and leaving one room at once")
+    storm.add_argument("--clients", default="100,1000")
+    storm.add_argument("--intervals", default="0,0.5", help="CHAT_PRESENCE_INTERVAL values, 0 = a message per join")
+    storm.add_argument("--output", default="bench-storm.json")
+    storm.set_defaults(func=bench_storm)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Pub/sub broker that lets several chat servers share one conversation.
+
+   python broker.py [port]
+
+Start it once, then start every server with CHAT_BUS=tcp://<broker-host>:<port>.
+Nodes and the broker exchange packets of a 4-byte length, a 1-byte op and a payload:
+
+   HELLO   node -> broker   highest user id the node has handed out (8 bytes)
+   ID      node -> broker   request a user id (empty)
+           broker -> node   the allocated id (8 bytes), replies in request order
+   PUBLISH node -> broker   a broadcast, forwarded verbatim to every other node;
+                            payload is the room (2-byte length prefix), the message
+                            kind (1 byte) and sender's user id (8 bytes), then the message
+   ONLINE  node -> broker   a user id (8 bytes) now connected to the node
+   OFFLINE node -> broker   a user id (8 bytes) no longer connected to it
+   DIRECT  node -> broker   a message for one user: target and sender user ids
+           broker -> node   (8 bytes each), then the message; forwarded only to
+                            the node the target is online on
+   UNDELIVERABLE            broker -> node, the target and sender of a DIRECT
+                            whose target is online nowhere
+   RESUMED node -> broker   a user id (8 bytes) whose session a reconnect took
+                            over, then the room it rejoined; forwarded to every
+                            other node, so the one holding its leave drops it
+   SYNC    node -> broker   asks every other node to publish who is in its
+                            rooms (empty); forwarded to them
+"""
+import asyncio
+import struct
+import sys
+
+
+DEFAULT_PORT = 7000
+MAX_PACKET = 16 * 1024 * 1024
+MAX_NODE_BACKLOG = 64 * 1024 * 1024  # bytes buffered for one node before it is cut off
+
+OP_HELLO = 1
+OP_ID = 2
+OP_PUBLISH = 3
+OP_ONLINE = 4
+OP_OFFLINE = 5
+OP_DIRECT = 6
+OP_UNDELIVERABLE = 7
+OP_RESUMED = 8
+OP_SYNC = 9
+
+HEADER = struct.Struct("!IB")
+USER_ID = struct.Struct("!Q")
+ROOM_LENGTH = struct.Struct("!H")
+SENDER = struct.Struct("!BQ")
+DIRECT = struct.Struct("!QQ")
+
+
+def encode_packet(op, payload=b""):
+    return HEADER.pack(len(payload), op) + payload
+
+
+def pack_publish(room, message, kind, user_id):
+    room = room.encode()
+    return ROOM_LENGTH.pack(len(room)) + room + SENDER.pack(kind, user_id) + message.encode()
+
+
+def unpack_publish(payload):
+    """Returns (room, message, kind, user_id)."""
+    (length,) = ROOM_LENGTH.unpack_from(payload)
+    start = ROOM_LENGTH.size + length
+    kind, user_id = SENDER.unpack_from(payload, start)
+    room = payload[ROOM_LENGTH.size:start].decode()
+    return room, payload[start + SENDER.size:].decode(), kind, user_id
+
+
+def pack_direct(message, target_id, user_id):
+    return DIRECT.pack(target_id, user_id) + message.encode()
+
+
+def unpack_direct(payload):
+    """Returns (message, target_id, user_id)."""
+    target_id, user_id = DIRECT.unpack_from(payload)
+    return payload[DIRECT.size:].decode(), target_id, user_id
+
+
+def pack_resumed(user_id, room):
+    return USER_ID.pack(user_id) + room.encode()
+
+
+def unpack_resumed(payload):
+    """Returns (user_id, room)."""
+    (user_id,) = USER_ID.unpack_from(payload)
+    return user_id, payload[USER_ID.size:].decode()
+
+
+async def read_packet(reader):
+    length, op = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if length > MAX_PACKET:
+        raise ValueError(f"packet of {length} bytes exceeds {MAX_PACKET}")
+    return op, await reader.readexactly(length)
+
+
+class Broker:
+    def __init__(self):
+        self.nodes = set()
+        self.next_user_id = 1
+        self.owners = {}  # user id -> writer of the node it is online on
+
+    async def handle_node(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        self.nodes.add(writer)
+        print(f"Node connected: {peer}")
+        try:
+            while True:
+                op, payload = await read_packet(reader)
+                if op == OP_HELLO:
+                    (highest,) = USER_ID.unpack(payload)
+                    self.next_user_id = max(self.next_user_id, highest + 1)
+                elif op == OP_ID:
+                    writer.write(encode_packet(OP_ID, USER_ID.pack(self.next_user_id)))
+                    self.next_user_id += 1
+                elif op == OP_PUBLISH:
+                    self.forward(encode_packet(OP_PUBLISH, payload), writer)
+                elif op == OP_ONLINE:
+                    (user_id,) = USER_ID.unpack(payload)
+                    self.owners[user_id] = writer
+                elif op == OP_OFFLINE:
+                    (user_id,) = USER_ID.unpack(payload)
+                    if self.owners.get(user_id) is writer:
+                        del self.owners[user_id]
+                elif op == OP_DIRECT:
+                    self.direct(payload, writer)
+                elif op in (OP_RESUMED, OP_SYNC):
+                    self.forward(encode_packet(op, payload), writer)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, struct.error):
+            pass
+        finally:
+            self.nodes.discard(writer)
+            for user_id in [user_id for user_id, owner in self.owners.items() if owner is writer]:
+                del self.owners[user_id]
+            writer.close()
+            print(f"Node disconnected: {peer}")
+
+    def direct(self, payload, origin):
+        (target_id,) = USER_ID.unpack_from(payload)
+        owner = self.owners.get(target_id)
+        if owner is None or owner is origin or owner not in self.nodes:
+            origin.write(encode_packet(OP_UNDELIVERABLE, payload[:DIRECT.size]))
+        else:
+            owner.write(encode_packet(OP_DIRECT, payload))
+
+    def forward(self, packet, origin):
+        for node in list(self.nodes):
+            if node is origin:
+                continue
+            if node.transport.get_write_buffer_size() > MAX_NODE_BACKLOG:
+                print(f"Dropping stalled node: {node.get_extra_info('peername')}")
+                self.nodes.discard(node)
+                node.close()
+                continue
+            node.write(packet)
+
+
+async def main(port):
+    broker = Broker()
+    server = await asyncio.start_server(broker.handle_node, "0.0.0.0", port)
+    print(f"Broker listening on 0.0.0.0:{port}")
+    print(f"Start chat servers with CHAT_BUS=tcp://<this host>:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT
+    try:
+        asyncio.run(main(port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,175 @@
+"""
+What the chat server and its clients share: colors, room names, connection
+passwords, compression settings and the binary wire protocol.
+
+Only the standard library is imported here, so the terminal client, which
+needs nothing else from server.py, starts without loading the web stack.
+"""
+import os
+import re
+import socket
+import struct
+
+
+# ANSI terminal colors
+ANSI_COLORS = [
+    "\033[91m",  # Red
+    "\033[92m",  # Green
+    "\033[93m",  # Yellow
+    "\033[94m",  # Blue
+    "\033[95m",  # Magenta
+    "\033[96m",  # Cyan
+    "\033[97m",  # White
+]
+ANSI_RESET = "\033[0m"
+
+
+def assign_color(user_id):
+    return (user_id - 1) % len(ANSI_COLORS)
+
+
+DEFAULT_ROOM = "main"
+ROOM_NAME = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+BINARY_SUBPROTOCOL = "chat.binary.v1"  # see "Binary wire protocol" below
+RESUMED_CLOSE_CODE = 4000  # the session was resumed on another connection
+NO_RECONNECT_CODES = (1008, RESUMED_CLOSE_CODE)  # closes after which clients give up
+
+
+# permessage-deflate for server-to-client frames:
+#   off     - not negotiated, every frame goes out as is
+#   shared  - no server context takeover, so each broadcast is compressed
+#             once and the same bytes go to every client
+#   context - context takeover, better ratio but compressed per client
+# Frames under COMPRESSION_MIN_BYTES are never compressed.
+COMPRESSION_MODES = ("off", "shared", "context")
+COMPRESSION = os.environ.get("CHAT_COMPRESSION", "shared")
+if COMPRESSION not in COMPRESSION_MODES:
+    raise ValueError(f"CHAT_COMPRESSION must be one of {', '.join(COMPRESSION_MODES)}")
+COMPRESSION_MIN_BYTES = int(os.environ.get("CHAT_COMPRESSION_MIN_BYTES", "1024"))
+COMPRESSION_LEVEL = int(os.environ.get("CHAT_COMPRESSION_LEVEL", "6"))
+COMPRESSION_WINDOW_BITS = int(os.environ.get("CHAT_COMPRESSION_WINDOW_BITS", "12"))
+if not 9 <= COMPRESSION_WINDOW_BITS <= 15:
+    raise ValueError("CHAT_COMPRESSION_WINDOW_BITS must be between 9 and 15")
+COMPRESSION_MEM_LEVEL = 5
+
+
+# ---------------- Password encoding/decoding ----------------
+
+
+ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def base36_encode(number: int) -> str:
+    if number == 0:
+        return "0"
+    result = []
+    while number:
+        number, rem = divmod(number, 36)
+        result.append(ALPHABET[rem])
+    return ''.join(reversed(result))
+
+
+def base36_decode(s: str) -> int:
+    n = 0
+    for ch in s.lower():
+        n = n * 36 + ALPHABET.index(ch)
+    return n
+
+
+def encode_ip_port(ip: str, port: int) -> str:
+    ip_int = struct.unpack("!I", socket.inet_aton(ip))[0]
+    combined = (ip_int << 16) + port
+    return base36_encode(combined)
+
+
+def decode_ip_port(code: str):
+    combined = base36_decode(code)
+    port = combined & 0xFFFF
+    ip_int = combined >> 16
+    ip = socket.inet_ntoa(struct.pack("!I", ip_int))
+    return ip, port
+
+
+# ---------------- Binary wire protocol ----------------
+
+
+# Clients that offer BINARY_SUBPROTOCOL get binary frames holding one or more
+# packets: version, kind, user id, seq and payload length, then the UTF-8 text.
+WIRE_VERSION = 1
+PACKET = struct.Struct("!BBIQI")
+
+KIND_TEXT = 1
+KIND_JOIN = 2
+KIND_LEAVE = 3
+KIND_SKIPPED = 4  # seq holds the number of messages skipped
+KIND_HEAD = 5  # opens a replay, seq holds the room's head
+KIND_SESSION = 6  # first packet on a connection: the client's user id and resume token
+KIND_DIRECT = 7  # a /msg for this client alone, from user id; seq is 0, it is not in the room's history
+KIND_NOTICE = 8  # the server's answer to this client alone, e.g. an undeliverable /msg
+KIND_PRESENCE = 9  # who is in the room, as JSON: {"present": [ids]} or {"joined": [ids], "left": [ids]}
+
+
+def encode_packet(kind, user_id, seq, text=""):
+    payload = text.encode()
+    return PACKET.pack(WIRE_VERSION, kind, user_id, seq, len(payload)) + payload
+
+
+def unpack_packets(data):
+    """
+    Returns (kind, user_id, seq, text) for every packet in data. Raises
+    ValueError on truncated packets or an unknown version.
+    """
+    packets = []
+    offset = 0
+    while offset < len(data):
+        if len(data) - offset < PACKET.size:
+            raise ValueError("truncated packet header")
+        version, kind, user_id, seq, length = PACKET.unpack_from(data, offset)
+        if version != WIRE_VERSION:
+            raise ValueError(f"unsupported wire version {version}")
+        offset += PACKET.size
+        if len(data) - offset < length:
+            raise ValueError("truncated packet payload")
+        packets.append((kind, user_id, seq, data[offset:offset + length].decode()))
+        offset += length
+    return packets
+
+
+# ---------------- Presence ----------------
+
+
+def presence_text(presence):
+    """
+    A presence snapshot or digest as a line to show, e.g.
+    "[users 3, 4 joined; user 5 left]".
+    """
+    parts = []
+    for key, verb in (("present", "in the room"), ("joined", "joined"), ("left", "left")):
+        ids = presence.get(key)
+        if ids:
+            parts.append(f"{'user' if len(ids) == 1 else 'users'} {', '.join(map(str, ids))} {verb}")
+    return "[" + "; ".join(parts or ["nobody in the room"]) + "]"
+
+
+# ---------------- Direct messages ----------------
+
+
+# "/msg <user id> <text>" sends text to that user alone
+DIRECT_COMMAND = "/msg"
+DIRECT_USAGE = "[usage: /msg <user id> <text>]"
+MAX_USER_ID = 2 ** 32 - 1  # widest id a packet's 4-byte user field holds
+
+
+def parse_direct(text):
+    """
+    (user id, text) for a "/msg <id> <text>" line, None for any other line.
+    Raises ValueError on a /msg without a numeric id or any text.
+    """
+    if not text.startswith(DIRECT_COMMAND) or text[len(DIRECT_COMMAND):len(DIRECT_COMMAND) + 1] not in ("", " "):
+        return None
+    target, _, body = text[len(DIRECT_COMMAND):].strip().partition(" ")
+    if not (target.isascii() and target.isdigit()) or len(target) > len(str(MAX_USER_ID)) or not body.strip():
+        raise ValueError(DIRECT_USAGE)
+    if int(target) > MAX_USER_ID:
+        raise ValueError(DIRECT_USAGE)
+    return int(target), body.lstrip()
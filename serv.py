@@ -1,5 +1,6 @@
 import os
 import asyncio
+import contextlib
 import sys
 import threading
 import socket
@@ -9,9 +10,16 @@ import base64
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.responses import HTMLResponse
+try:
+    import numpy
+except ImportError:
+    numpy = None
 import uvicorn
+from uvicorn.protocols.websockets.websockets_sansio_impl import WebSocketsSansIOProtocol
 import websockets
 
+import tracing
+
 # -------------------- Terminal colors --------------------
 ANSI_COLORS = [
     "\033[91m",  # Red
@@ -37,9 +45,37 @@ WEB_COLORS = [
 # -------------------- Clear terminal --------------------
 os.system('cls' if os.name == 'nt' else 'clear')
 
-app = FastAPI()
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Loop-lag monitor and SIGUSR1 trace dumps, when CHAT_TRACE_* asks for them
+    tracing.start()
+    try:
+        yield
+    finally:
+        await tracing.stop()
+
+app = FastAPI(lifespan=lifespan)
+
+# Outbound watermark per client: messages and total frame bytes buffered
+# before the slow-consumer policy kicks in
+SEND_QUEUE_SIZE = int(os.environ.get("CHAT_SEND_QUEUE_SIZE", "256"))
+SEND_QUEUE_BYTES = int(os.environ.get("CHAT_SEND_QUEUE_BYTES", str(1024 * 1024)))
+
+# drop-oldest / coalesce ("N messages skipped" marker) / disconnect
+SLOW_CONSUMER_POLICIES = ("drop-oldest", "coalesce", "disconnect")
+SLOW_CONSUMER_POLICY = os.environ.get("CHAT_SLOW_CONSUMER_POLICY", "drop-oldest")
+if SLOW_CONSUMER_POLICY not in SLOW_CONSUMER_POLICIES:
+    raise ValueError(f"CHAT_SLOW_CONSUMER_POLICY must be one of {', '.join(SLOW_CONSUMER_POLICIES)}")
+SLOW_CONSUMER_CLOSE_CODE = 1013  # "Try Again Later"
+SLOW_CONSUMER_CLOSE_TIMEOUT = 5.0
+
 clients = set()
 client_info = {}  # websocket -> {"id": int, "color_idx": int}
+send_queues = {}  # websocket -> asyncio.Queue of outbound text frames
+queued_bytes = {}  # websocket -> frame bytes currently sitting in its send queue
+slow_consumer_stats = {"dropped": 0, "coalesced": 0, "disconnected": 0}
+writer_tasks = {}  # websocket -> asyncio.Task draining its send queue
+background_tasks = set()  # fire-and-forget tasks, referenced until they finish
 next_user_id = 1
 lock = asyncio.Lock()
 
@@ -90,17 +126,43 @@ def decode_ip_port(code: str):
 
 # -------------------- XOR “encryption” --------------------
 ENCRYPTION_KEY = "supersecret"
+NUMPY_XOR_MIN_BYTES = 1024  # below this one big-int XOR beats a NumPy round trip
+
+_keystreams = {}  # key -> key bytes repeated out to the longest message seen so far
+
+def keystream(key, length):
+    stream = _keystreams.get(key)
+    if stream is None or len(stream) < length:
+        # ord() per character like the original cipher; non-Latin-1 keys raise ValueError
+        key_bytes = bytes(ord(c) for c in key)
+        if not key_bytes:
+            raise ValueError("encryption key must not be empty")
+        size = max(length, 2 * len(stream) if stream else 0)
+        stream = (key_bytes * (size // len(key_bytes) + 1))[:size]
+        _keystreams[key] = stream
+    return stream
+
+def xor_bytes(data: bytes, key=ENCRYPTION_KEY) -> bytes:
+    # Whole-buffer XOR against the cached keystream, byte-identical to
+    # b ^ ord(key[i % len(key)]) for every byte
+    length = len(data)
+    if length == 0:
+        return b""
+    stream = keystream(key, length)
+    if numpy is not None and length >= NUMPY_XOR_MIN_BYTES:
+        return numpy.bitwise_xor(
+            numpy.frombuffer(data, numpy.uint8),
+            numpy.frombuffer(stream, numpy.uint8, length),
+        ).tobytes()
+    mixed = int.from_bytes(data, "big") ^ int.from_bytes(memoryview(stream)[:length], "big")
+    return mixed.to_bytes(length, "big")
 
 def encrypt_message(message: str, key=ENCRYPTION_KEY) -> str:
-    key_len = len(key)
-    encrypted_bytes = bytes([b ^ ord(key[i % key_len]) for i, b in enumerate(message.encode())])
-    return base64.b64encode(encrypted_bytes).decode()
+    return base64.b64encode(xor_bytes(message.encode(), key)).decode()
 
 def decrypt_message(message: str, key=ENCRYPTION_KEY) -> str:
     try:
-        encrypted_bytes = base64.b64decode(message)
-        decrypted_bytes = bytes([b ^ ord(key[i % len(key)]) for i, b in enumerate(encrypted_bytes)])
-        return decrypted_bytes.decode()
+        return xor_bytes(base64.b64decode(message), key).decode()
     except:
         return message
 
@@ -228,38 +290,186 @@ async def websocket_endpoint(websocket: WebSocket):
         next_user_id += 1
         color_idx = assign_color(user_id)
         client_info[websocket] = {"id": user_id, "color_idx": color_idx}
+    start_writer(websocket, websocket.scope["extensions"].get("chat.frame_writer"))
     clients.add(websocket)
 
     join_msg = f"{color_idx}:"
-    await broadcast(join_msg, exclude=None)
+    broadcast(join_msg, exclude=None)
 
     try:
         while True:
+            waiting = time.perf_counter() if tracing.SAMPLE else None
             data = await websocket.receive_text()
+            trace = tracing.begin(user_id, start=waiting) if waiting else None
+            if trace:
+                trace.mark("receive")  # includes waiting for the client to send
             user = client_info.get(websocket)
             if user:
                 enc_msg = encrypt_message(data)
+                if trace:
+                    trace.mark("encrypt")
                 msg = f"{user['color_idx']}:{enc_msg}"
-                await broadcast(msg, exclude=websocket)
+                if trace:
+                    trace.mark("format")
+                broadcast(msg, exclude=websocket)
+                if trace:
+                    trace.mark("broadcast")
+                    trace.end()
     except WebSocketDisconnect:
         clients.discard(websocket)
         user = client_info.pop(websocket, None)
         if user:
             leave_msg = f"{user['color_idx']}:"
-            await broadcast(leave_msg, exclude=None)
+            broadcast(leave_msg, exclude=None)
+    finally:
+        stop_writer(websocket)
+
+# -------------------- Shared broadcast frames --------------------
+class FrameWriterProtocol(WebSocketsSansIOProtocol):
+    # Publishes uvicorn's protocol in the ASGI scope so one prebuilt frame
+    # can go to many transports without re-framing
+    def handle_connect(self, event):
+        super().handle_connect(event)
+        scope = getattr(self, "scope", None)
+        if scope is not None:
+            scope["extensions"]["chat.frame_writer"] = self
+
+def encode_text_frame(message):
+    # Unmasked, unfragmented server-to-client text frame
+    payload = message.encode()
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x81, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x81, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x81, 127, length)
+    return header + payload
+
+def frame_text(frame):
+    length = frame[1] & 0x7F
+    offset = 2 if length < 126 else 4 if length == 126 else 10
+    return frame[offset:].decode()
+
+async def write_frame(websocket, protocol, frame):
+    # Straight to the transport under FrameWriterProtocol, send_text() otherwise
+    if protocol is None:
+        await websocket.send_text(frame_text(frame))
+        return
+    await protocol.writable.wait()
+    if protocol.close_sent or protocol.transport.is_closing():
+        raise ConnectionError("connection is closing")
+    protocol.transport.write(frame)
+
+# -------------------- Outbound queues --------------------
+class Skipped:
+    # Queue entry standing in for messages a slow client never received
+    def __init__(self, count):
+        self.count = count
+
+    def __str__(self):
+        return f"[{self.count} messages skipped]"
+
+def start_writer(websocket, protocol=None):
+    queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+    send_queues[websocket] = queue
+    queued_bytes[websocket] = 0
+    writer_tasks[websocket] = asyncio.create_task(client_writer(websocket, queue, protocol))
+
+def stop_writer(websocket):
+    send_queues.pop(websocket, None)
+    queued_bytes.pop(websocket, None)
+    task = writer_tasks.pop(websocket, None)
+    if task is not None and task is not asyncio.current_task():
+        task.cancel()
+
+def remove_client(websocket):
+    clients.discard(websocket)
+    client_info.pop(websocket, None)
+    stop_writer(websocket)
+
+async def client_writer(websocket, queue, protocol=None):
+    # One writer per client, so a slow socket only ever delays itself
+    try:
+        while True:
+            frame = await queue.get()
+            if isinstance(frame, Skipped):
+                frame = encode_text_frame(str(frame))
+            else:
+                queued_bytes[websocket] -= len(frame)
+            await write_frame(websocket, protocol, frame)
+    except asyncio.CancelledError:
+        raise
+    except:
+        remove_client(websocket)
+
+def spawn(coroutine):
+    # Runs coroutine as a task nobody awaits, keeping it from being collected first
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
 
-async def broadcast(message, exclude=None):
+async def close_slow_consumer(websocket):
+    try:
+        await asyncio.wait_for(
+            websocket.close(code=SLOW_CONSUMER_CLOSE_CODE, reason="slow consumer"),
+            SLOW_CONSUMER_CLOSE_TIMEOUT,
+        )
+    except Exception:
+        pass
+
+def make_room(websocket, queue, size):
+    # drop-oldest / coalesce for a client that cannot take size more bytes;
+    # False means the message was folded into a skipped marker instead
+    if SLOW_CONSUMER_POLICY == "drop-oldest":
+        while not queue.empty() and (
+            queue.full() or queued_bytes[websocket] + size > SEND_QUEUE_BYTES
+        ):
+            old = queue.get_nowait()
+            if not isinstance(old, Skipped):
+                queued_bytes[websocket] -= len(old)
+            slow_consumer_stats["dropped"] += 1
+        return True
+
+    folded = 1  # the message that did not fit
+    skipped = 0
+    while not queue.empty():
+        old = queue.get_nowait()
+        if isinstance(old, Skipped):
+            skipped += old.count
+        else:
+            folded += 1
+    queued_bytes[websocket] = 0
+    queue.put_nowait(Skipped(skipped + folded))
+    slow_consumer_stats["coalesced"] += folded
+    return False
+
+def broadcast(message, exclude=None):
+    # Frame once, enqueue the same bytes everywhere; never awaits a socket.
+    # Clients over the watermark get SLOW_CONSUMER_POLICY
+    frame = encode_text_frame(message)
+    size = len(frame)
     to_remove = []
     for client in clients:
         if client == exclude:
             continue
-        try:
-            await client.send_text(message)
-        except:
+        queue = send_queues.get(client)
+        if queue is None:
             to_remove.append(client)
+            continue
+        if queue.full() or queued_bytes[client] + size > SEND_QUEUE_BYTES:
+            if SLOW_CONSUMER_POLICY == "disconnect":
+                slow_consumer_stats["disconnected"] += 1
+                spawn(close_slow_consumer(client))
+                to_remove.append(client)
+                continue
+            if not make_room(client, queue, size):
+                continue
+        queue.put_nowait(frame)
+        queued_bytes[client] += size
     for client in to_remove:
-        clients.discard(client)
-        client_info.pop(client, None)
+        remove_client(client)
 
 # -------------------- Terminal client --------------------
 def color_message_terminal(message):
@@ -394,7 +604,7 @@ if __name__ == "__main__":
         print(f"Clients can connect via ws://{ip}:{port}/ws or open http://{ip}:{port}/ in browser\n")
 
         def run_uvicorn():
-            uvicorn.run(app, host="0.0.0.0", port=port)
+            uvicorn.run(app, host="0.0.0.0", port=port, ws=FrameWriterProtocol)
         server_thread = threading.Thread(target=run_uvicorn, daemon=True)
         server_thread.start()
 
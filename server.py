@@ -1,38 +1,104 @@
-import os
-import asyncio
 import sys
-import threading
-import socket
-import struct
 
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse
-import uvicorn
-import websockets
-
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1].lower() == "--terminal":
+   # The terminal client needs none of the web stack imported below
+   import terminal
+   terminal.main()
+   sys.exit()
 
-# Clear terminal at start
-os.system('cls' if os.name == 'nt' else 'clear')
 
+import os
+import argparse
+import asyncio
+import collections
+import bisect
+import contextlib
+import functools
+import gzip
+import hashlib
+import hmac
+import itertools
+import json
+import math
+import mmap
+import random
+import shutil
+import signal
+import socket
+import struct
+import tempfile
+import time
+import traceback
+import zlib
+
+
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import Response
+try:
+   import brotli
+except ImportError:
+   brotli = None
+import uvicorn
+from uvicorn.protocols.websockets.websockets_sansio_impl import WebSocketsSansIOProtocol
+from websockets.exceptions import PayloadTooBig
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+
+
+import broker
+import tracing
+from protocol import (
+   BINARY_SUBPROTOCOL,
+   COMPRESSION,
+   COMPRESSION_LEVEL,
+   COMPRESSION_MEM_LEVEL,
+   COMPRESSION_MIN_BYTES,
+   COMPRESSION_WINDOW_BITS,
+   DEFAULT_ROOM,
+   KIND_DIRECT,
+   KIND_HEAD,
+   KIND_JOIN,
+   KIND_LEAVE,
+   KIND_NOTICE,
+   KIND_PRESENCE,
+   KIND_SESSION,
+   KIND_SKIPPED,
+   KIND_TEXT,
+   RESUMED_CLOSE_CODE,
+   ROOM_NAME,
+   assign_color,
+   encode_ip_port,
+   encode_packet,
+   parse_direct,
+   presence_text,
+   unpack_packets,
+)
+from terminal import chat_uri, choose_room, clear_screen, terminal_client
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+   await bus.start()
+   flusher = asyncio.create_task(flush_logs_forever()) if LOG_DIR else None
+   heartbeat = asyncio.create_task(heartbeat_forever()) if heartbeats_enabled() else None
+   tracing.start()
+   try:
+       yield
+   finally:
+       await tracing.stop()
+       if heartbeat is not None:
+           heartbeat.cancel()
+       stop_presence()
+       if flusher is not None:
+           flusher.cancel()
+           await flush_logs()
+       await bus.stop()
 
-app = FastAPI()
 
+app = FastAPI(lifespan=lifespan)
 
-# ANSI terminal colors
-ANSI_COLORS = [
-   "\033[91m",  # Red
-   "\033[92m",  # Green
-   "\033[93m",  # Yellow
-   "\033[94m",  # Blue
-   "\033[95m",  # Magenta
-   "\033[96m",  # Cyan
-   "\033[97m",  # White
-]
-ANSI_RESET = "\033[0m"
 
-
-# Web CSS colors (same order)
+# Web CSS colors (same order as protocol.ANSI_COLORS)
 WEB_COLORS = [
    "red",
    "green",
@@ -44,14 +110,114 @@ WEB_COLORS = [
 ]
 
 
-clients = set()
-client_info = {}  # websocket -> {"id": int, "color_idx": int}
-next_user_id = 1
-lock = asyncio.Lock()
-
-
-def assign_color(user_id):
-   return (user_id - 1) % len(ANSI_COLORS)
+# Outbound watermark per client: messages and total frame bytes buffered
+# before the slow-consumer policy kicks in
+SEND_QUEUE_SIZE = int(os.environ.get("CHAT_SEND_QUEUE_SIZE", "256"))
+SEND_QUEUE_BYTES = int(os.environ.get("CHAT_SEND_QUEUE_BYTES", str(1024 * 1024)))
+
+
+# What to do with a client whose outbound queue hits the watermark:
+#   drop-oldest - discard the oldest queued messages to make room
+#   coalesce    - collapse everything queued into one "N messages skipped" marker
+#   disconnect  - close the connection with SLOW_CONSUMER_CLOSE_CODE
+SLOW_CONSUMER_POLICIES = ("drop-oldest", "coalesce", "disconnect")
+SLOW_CONSUMER_POLICY = os.environ.get("CHAT_SLOW_CONSUMER_POLICY", "drop-oldest")
+if SLOW_CONSUMER_POLICY not in SLOW_CONSUMER_POLICIES:
+   raise ValueError(f"CHAT_SLOW_CONSUMER_POLICY must be one of {', '.join(SLOW_CONSUMER_POLICIES)}")
+SLOW_CONSUMER_CLOSE_CODE = 1013  # "Try Again Later"
+SLOW_CONSUMER_CLOSE_TIMEOUT = 5.0
+
+
+# Limits on what one client can push. Each connection and each client IP get
+# a token bucket of RATE_BURST (IP_RATE_BURST) messages refilled at
+# RATE_MESSAGES (IP_RATE_MESSAGES) a second; messages over either are dropped,
+# and a connection that has RATE_LIMIT_CLOSE_AFTER dropped in a row is closed
+# with 1008. Messages over MAX_MESSAGE_BYTES are refused with 1009 as soon as a
+# frame header announces them, before the payload is read. Past MAX_CONNECTIONS
+# clients, new connections are closed with 1013. 0 turns a limit off.
+RATE_MESSAGES = float(os.environ.get("CHAT_RATE_MESSAGES", "20"))
+RATE_BURST = int(os.environ.get("CHAT_RATE_BURST", "60"))
+IP_RATE_MESSAGES = float(os.environ.get("CHAT_IP_RATE_MESSAGES", "100"))
+IP_RATE_BURST = int(os.environ.get("CHAT_IP_RATE_BURST", "300"))
+RATE_LIMIT_CLOSE_AFTER = int(os.environ.get("CHAT_RATE_LIMIT_CLOSE_AFTER", "100"))
+MAX_MESSAGE_BYTES = int(os.environ.get("CHAT_MAX_MESSAGE_BYTES", str(64 * 1024)))
+MAX_CONNECTIONS = int(os.environ.get("CHAT_MAX_CONNECTIONS", "10000"))
+RATE_LIMITED_IPS = 100000  # client IPs whose bucket is kept, the least recently seen forgotten first
+
+
+# Per-room history kept for replay, capped in messages and frame bytes,
+# plus the number of rooms whose history is retained at all
+HISTORY_MESSAGES = int(os.environ.get("CHAT_HISTORY_MESSAGES", "1000"))
+HISTORY_BYTES = int(os.environ.get("CHAT_HISTORY_BYTES", str(1024 * 1024)))
+HISTORY_ROOMS = int(os.environ.get("CHAT_HISTORY_ROOMS", "1000"))
+REPLAY_MESSAGES = int(os.environ.get("CHAT_REPLAY_MESSAGES", "10000"))  # most a single replay sends
+
+
+# Clients connecting with ?batch=1 get messages gathered for up to BATCH_MS
+# milliseconds or BATCH_BYTES bytes into one {"batch": [...]} frame.
+# BATCH_MS = 0 turns batching off and every client gets one frame per message.
+BATCH_MS = float(os.environ.get("CHAT_BATCH_MS", "0"))
+BATCH_BYTES = int(os.environ.get("CHAT_BATCH_BYTES", str(64 * 1024)))
+
+
+# Optional on-disk log of every broadcast, one directory per room, split into
+# segments of LOG_SEGMENT_BYTES of which the newest LOG_SEGMENTS are kept.
+# Writes are batched and fsynced every LOG_FSYNC_INTERVAL seconds.
+LOG_DIR = os.environ.get("CHAT_LOG_DIR", "")
+LOG_SEGMENT_BYTES = int(os.environ.get("CHAT_LOG_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+LOG_SEGMENTS = int(os.environ.get("CHAT_LOG_SEGMENTS", "16"))
+LOG_FSYNC_INTERVAL = float(os.environ.get("CHAT_LOG_FSYNC_INTERVAL", "1.0"))
+
+
+# Binary and sequenced clients get a session token they can present with
+# ?resume= when they reconnect. A client that drops without a clean close
+# has RESUME_GRACE seconds to come back before its leave is announced, and
+# a resumed client is not announced again. Tokens are signed with
+# CHAT_SESSION_SECRET, or a secret kept in LOG_DIR, so they survive restarts;
+# without either they only work until this process exits.
+RESUME_GRACE = float(os.environ.get("CHAT_RESUME_GRACE", "10"))
+RECENT_LEAVES = 10000  # user ids whose leave was announced, remembered for late resumes
+
+
+# A client silent for PING_INTERVAL seconds is pinged, and one silent for
+# IDLE_TIMEOUT is dropped and its leave announced; any frame it sends,
+# pongs included, counts as activity. One timer wheel ticking every
+# HEARTBEAT_TICK seconds drives both for every connection, in place of
+# uvicorn's ping and pong timers per socket. 0 turns pings or the reaper off.
+PING_INTERVAL = float(os.environ.get("CHAT_PING_INTERVAL", "20"))
+IDLE_TIMEOUT = float(os.environ.get("CHAT_IDLE_TIMEOUT", "60"))
+HEARTBEAT_TICK = float(os.environ.get("CHAT_HEARTBEAT_TICK", "1"))
+
+
+# Joins and leaves are gathered for PRESENCE_INTERVAL seconds and sent as one
+# {"joined", "left"} digest per room instead of a message per event to every
+# member, so 1000 clients joining cost each member one message rather than
+# 1000; a join and leave inside one interval cancel out. A new client gets
+# one snapshot of who is in the room instead. 0 sends every event at once.
+PRESENCE_INTERVAL = float(os.environ.get("CHAT_PRESENCE_INTERVAL", "0.5"))
+
+
+sessions = {}  # websocket -> Session, every connected client
+sessions_by_id = {}  # user id -> its current Session
+rooms = {}  # room name -> set of Sessions subscribed to it
+histories = collections.OrderedDict()  # room name -> History, least recently used first
+evicted_heads = {}  # room name -> last seq of a History evicted without LOG_DIR to carry it on
+logs = collections.OrderedDict()  # room name -> MessageLog, only when LOG_DIR is set, least recently used first
+slow_consumer_stats = {"dropped": 0, "coalesced": 0, "disconnected": 0}
+compression_stats = {"frames": 0, "bytes_in": 0, "bytes_out": 0, "cpu_seconds": 0.0}
+chat_stats = {"joins": 0, "leaves": 0, "received": 0, "delivered": 0, "send_failures": 0}
+limit_stats = {"connection_rate": 0, "ip_rate": 0, "rate_closed": 0, "message_size": 0, "connections": 0}
+ip_buckets = collections.OrderedDict()  # client IP -> TokenBucket, least recently seen first
+pending_leaves = {}  # user id -> (TimerHandle, room, color_idx) of a leave held back for RESUME_GRACE
+announced_leaves = collections.OrderedDict()  # user id -> None, the last RECENT_LEAVES leaves announced
+heartbeat_stats = {"pings": 0, "reaped": 0}
+background_tasks = set()  # fire-and-forget tasks, referenced until they finish
+direct_stats = {"delivered": 0, "forwarded": 0, "undeliverable": 0}
+presence = {}  # room name -> ids of the users in it, on any node
+presence_changes = {}  # room name -> {user id: True if it joined, False if it left} since the last digest
+presence_newcomers = {}  # room name -> set of Sessions owed a presence snapshot
+presence_flush = None  # TimerHandle of the next flush_presence(), while one is due
+presence_stats = {"digests": 0, "snapshots": 0, "events": 0, "cancelled": 0}
 
 
 def get_local_ip():
@@ -66,48 +232,10 @@ def get_local_ip():
    return IP
 
 
-# ---------------- Password encoding/decoding ----------------
-
-
-ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyz"
-
-
-def base36_encode(number: int) -> str:
-   if number == 0:
-       return "0"
-   result = []
-   while number:
-       number, rem = divmod(number, 36)
-       result.append(ALPHABET[rem])
-   return ''.join(reversed(result))
-
-
-def base36_decode(s: str) -> int:
-   n = 0
-   for ch in s.lower():
-       n = n * 36 + ALPHABET.index(ch)
-   return n
-
-
-def encode_ip_port(ip: str, port: int) -> str:
-   ip_int = struct.unpack("!I", socket.inet_aton(ip))[0]
-   combined = (ip_int << 16) + port
-   return base36_encode(combined)
-
-
-def decode_ip_port(code: str):
-   combined = base36_decode(code)
-   port = combined & 0xFFFF
-   ip_int = combined >> 16
-   ip = socket.inet_ntoa(struct.pack("!I", ip_int))
-   return ip, port
-
-
 # ------------- FastAPI Web Server and WebSocket ----------------
 
 
-@app.get("/", response_class=HTMLResponse)
-async def get():
+def render_index_page():
    return f"""
 <!DOCTYPE html>
 <html>
@@ -126,9 +254,23 @@ async def get():
        #chat {{
            flex-grow: 1;
            overflow-y: auto;
-           white-space: pre-wrap;
+           position: relative;
            padding-bottom: 10px;
        }}
+       #spacer {{
+           width: 1px;
+       }}
+       #rows {{
+           position: absolute;
+           top: 0; left: 0; right: 0;
+           will-change: transform;
+       }}
+       .row {{
+           white-space: pre;
+           overflow: hidden;
+           height: 1.25em;
+           line-height: 1.25em;
+       }}
        #inputLine {{
            display: flex;
        }}
@@ -161,49 +303,273 @@ async def get():
    </style>
 </head>
 <body>
-   <div id="chat"></div>
+   <div id="chat"><div id="spacer"></div><div id="rows"></div></div>
    <div id="inputLine">
        <div id="prompt">&gt;</div>
        <input id="msg" autocomplete="off" autofocus />
    </div>
    <script>
        const chat = document.getElementById('chat');
+       const spacer = document.getElementById('spacer');
+       const rowsEl = document.getElementById('rows');
        const input = document.getElementById('msg');
+       const room = new URLSearchParams(location.search).get('room') || '{DEFAULT_ROOM}';
        let ws;
+       let session = null;    // resume token from the server's session packet
+       let lastSeq = null;    // newest sequence number seen, for ?since= on reconnect
+       let attempt = 0;       // reconnects since the last frame that arrived
+       let reconnecting = false;
 
 
        const USER_COLORS = {WEB_COLORS};
 
 
+       // The transcript is virtualized: messages are wrapped into fixed-height
+       // visual lines (the font is monospace), and only the rows in view plus
+       // OVERSCAN on each side exist in the DOM, recycled as the user scrolls.
+       const MAX_LINES = 200000;
+       const OVERSCAN = 10;
+       const messages = [];   // parsed messages, oldest first
+       let lines = [];        // wrapped visual lines of those messages
+       let pending = [];      // messages waiting for the next animation frame
+       const pool = [];       // recycled row elements
+       let rowHeight = 16;
+       let columns = 80;
+       let flushScheduled = false;
+       let renderScheduled = false;
+
+
        function parseMessage(message) {{
            const colonPos = message.indexOf(':');
            if (colonPos > -1) {{
                const colorIdx = parseInt(message.slice(0, colonPos));
-               const text = message.slice(colonPos + 1);
-               const color = USER_COLORS[colorIdx % USER_COLORS.length] || 'white';
-               if (text.trim() === '') {{
-                   return `<span style="color:${{color}}">|</span>`;
-               }} else {{
-                   return `<span style="color:${{color}}">|</span> ${{text}}`;
+               if (!isNaN(colorIdx)) {{
+                   const text = message.slice(colonPos + 1);
+                   const color = USER_COLORS[colorIdx % USER_COLORS.length] || 'white';
+                   return {{ color: color, text: text.trim() === '' ? '' : text }};
+               }}
+           }}
+           return {{ color: null, text: message }};
+       }}
+
+
+       function wrap(message, out) {{
+           const width = Math.max(columns - (message.color ? 2 : 0), 1);
+           let first = true;
+           message.lineCount = 0;
+           for (const part of message.text.split('\\n')) {{
+               for (let i = 0; i === 0 || i < part.length; i += width) {{
+                   out.push({{ color: message.color, text: part.slice(i, i + width), first: first }});
+                   first = false;
+                   message.lineCount++;
+               }}
+           }}
+       }}
+
+
+       function measure() {{
+           const probe = document.createElement('div');
+           probe.className = 'row';
+           probe.style.visibility = 'hidden';
+           probe.style.display = 'inline-block';
+           probe.textContent = 'M'.repeat(100);
+           rowsEl.appendChild(probe);
+           const rect = probe.getBoundingClientRect();
+           rowsEl.removeChild(probe);
+           rowHeight = rect.height || rowHeight;
+           columns = Math.max(Math.floor(chat.clientWidth / (rect.width / 100 || 8)), 10);
+       }}
+
+
+       function createRow() {{
+           const row = document.createElement('div');
+           row.className = 'row';
+           row.bar = row.appendChild(document.createElement('span'));
+           row.text = row.appendChild(document.createTextNode(''));
+           rowsEl.appendChild(row);
+           pool.push(row);
+       }}
+
+
+       function render() {{
+           renderScheduled = false;
+           const first = Math.max(Math.floor(chat.scrollTop / rowHeight) - OVERSCAN, 0);
+           const count = Math.max(Math.min(Math.ceil(chat.clientHeight / rowHeight) + 2 * OVERSCAN, lines.length - first), 0);
+           while (pool.length < count) createRow();
+           for (let i = 0; i < pool.length; i++) {{
+               const row = pool[i];
+               if (i >= count) {{
+                   row.style.display = 'none';
+                   continue;
                }}
+               const line = lines[first + i];
+               row.style.display = '';
+               row.bar.textContent = line.color ? (line.first ? '| ' : '  ') : '';
+               row.bar.style.color = line.color || '';
+               row.text.data = line.text;
+           }}
+           rowsEl.style.transform = `translateY(${{first * rowHeight}}px)`;
+       }}
+
+
+       function scheduleRender() {{
+           if (!renderScheduled) {{
+               renderScheduled = true;
+               requestAnimationFrame(render);
+           }}
+       }}
+
+
+       function trim() {{
+           if (lines.length <= MAX_LINES) return 0;
+           let drop = 0, count = 0;
+           while (lines.length - drop > MAX_LINES * 0.9) drop += messages[count++].lineCount;
+           messages.splice(0, count);
+           lines.splice(0, drop);
+           return drop;
+       }}
+
+
+       function flush() {{
+           flushScheduled = false;
+           const atBottom = chat.scrollTop + chat.clientHeight >= chat.scrollHeight - rowHeight;
+           for (const message of pending) {{
+               messages.push(message);
+               wrap(message, lines);
+           }}
+           pending = [];
+           const dropped = trim();
+           spacer.style.height = (lines.length * rowHeight) + 'px';
+           if (atBottom) {{
+               chat.scrollTop = chat.scrollHeight;
+           }} else if (dropped) {{
+               chat.scrollTop -= dropped * rowHeight;
+           }}
+           render();
+       }}
+
+
+       function queueMessage(message) {{
+           pending.push(message);
+           if (!flushScheduled) {{
+               flushScheduled = true;
+               requestAnimationFrame(flush);
            }}
-           return message;
        }}
 
 
        function appendMessage(message) {{
-           chat.innerHTML += parseMessage(message) + '\\n';
-           chat.scrollTop = chat.scrollHeight;
+           queueMessage(parseMessage(message));
+       }}
+
+
+       function receiveFrame(data) {{
+           // With ?batch=1 the server may gather several messages into {{"batch": [...]}}
+           if (data.startsWith('{{')) {{
+               let frame = null;
+               try {{ frame = JSON.parse(data); }} catch (e) {{}}
+               if (frame && Array.isArray(frame.batch)) {{
+                   for (const item of frame.batch) {{
+                       if (typeof item === 'string') appendMessage(item);
+                       else if (item.skipped) appendMessage('[' + item.skipped + ' messages skipped]');
+                       else if (item.msg !== undefined) appendMessage(item.msg);
+                   }}
+                   return;
+               }}
+           }}
+           appendMessage(data);
+       }}
+
+
+       // chat.binary.v1 packets: version, kind, user id, seq (8 bytes) and
+       // payload length, big-endian, then the UTF-8 text
+       const PACKET_SIZE = 18;
+       const KIND = {{ TEXT: 1, JOIN: 2, LEAVE: 3, SKIPPED: 4, HEAD: 5, SESSION: 6, DIRECT: 7, NOTICE: 8, PRESENCE: 9 }};
+       const decoder = new TextDecoder();
+
+
+       // {{"present": [ids]}} when joining, {{"joined": [ids], "left": [ids]}} after
+       function presenceText(presence) {{
+           const parts = [];
+           for (const [key, verb] of [['present', 'in the room'], ['joined', 'joined'], ['left', 'left']]) {{
+               const ids = presence[key];
+               if (ids && ids.length) parts.push((ids.length === 1 ? 'user ' : 'users ') + ids.join(', ') + ' ' + verb);
+           }}
+           return '[' + (parts.length ? parts.join('; ') : 'nobody in the room') + ']';
+       }}
+
+
+       function receivePackets(buffer) {{
+           const view = new DataView(buffer);
+           let offset = 0;
+           while (offset + PACKET_SIZE <= buffer.byteLength) {{
+               const kind = view.getUint8(offset + 1);
+               const userId = view.getUint32(offset + 2);
+               const seq = view.getUint32(offset + 6) * 4294967296 + view.getUint32(offset + 10);
+               const length = view.getUint32(offset + 14);
+               const text = decoder.decode(new Uint8Array(buffer, offset + PACKET_SIZE, length));
+               offset += PACKET_SIZE + length;
+               if (kind === KIND.SESSION) {{
+                   session = text;
+                   continue;
+               }}
+               if (kind === KIND.NOTICE) {{
+                   queueMessage({{ color: null, text: text }});
+                   continue;
+               }}
+               if (kind === KIND.PRESENCE) {{
+                   queueMessage({{ color: null, text: presenceText(JSON.parse(text)) }});
+                   continue;
+               }}
+               // Direct messages are not part of the room, so they have no position in it
+               if (kind !== KIND.SKIPPED && kind !== KIND.DIRECT) lastSeq = seq;
+               const color = USER_COLORS[(userId - 1) % USER_COLORS.length] || 'white';
+               if (kind === KIND.TEXT) queueMessage({{ color: color, text: text.trim() === '' ? '' : text }});
+               else if (kind === KIND.DIRECT) queueMessage({{ color: color, text: '[from ' + userId + '] ' + text }});
+               else if (kind === KIND.JOIN) queueMessage({{ color: color, text: '[user ' + userId + ' joined]' }});
+               else if (kind === KIND.LEAVE) queueMessage({{ color: color, text: '[user ' + userId + ' left]' }});
+               else if (kind === KIND.SKIPPED) queueMessage({{ color: null, text: '[' + seq + ' messages skipped]' }});
+           }}
+       }}
+
+
+       function rewrap() {{
+           const anchor = lines.length ? chat.scrollTop / (lines.length * rowHeight) : 1;
+           measure();
+           lines = [];
+           for (const message of messages) wrap(message, lines);
+           spacer.style.height = (lines.length * rowHeight) + 'px';
+           chat.scrollTop = anchor * lines.length * rowHeight;
+           render();
        }}
 
 
        function connect() {{
            const protocol = location.protocol === 'https:' ? 'wss://' : 'ws://';
-           ws = new WebSocket(protocol + location.host + '/ws');
-           ws.onopen = () => appendMessage('[Connected to server]');
-           ws.onmessage = (event) => appendMessage(event.data);
-           ws.onclose = () => appendMessage('[Disconnected]');
-           ws.onerror = () => appendMessage('[Connection error]');
+           let url = protocol + location.host + '/ws/' + encodeURIComponent(room) + '?batch=1';
+           if (session !== null) url += '&resume=' + encodeURIComponent(session);
+           if (lastSeq !== null) url += '&since=' + lastSeq;
+           ws = new WebSocket(url, ['{BINARY_SUBPROTOCOL}']);
+           ws.binaryType = 'arraybuffer';
+           ws.onopen = () => appendMessage(
+               reconnecting ? '[Reconnected]' : '[Connected to room ' + room + ', /msg <user id> <text> messages one user]'
+           );
+           ws.onmessage = (event) => {{
+               attempt = 0;
+               typeof event.data === 'string' ? receiveFrame(event.data) : receivePackets(event.data);
+           }};
+           ws.onclose = (event) => {{
+               if (event.code === 1008 || event.code === {RESUMED_CLOSE_CODE}) {{
+                   appendMessage('[Disconnected: ' + event.reason + ']');
+                   return;
+               }}
+               // Full jitter, so a restarted server is not hit by every page at once
+               const delay = Math.random() * Math.min(30000, 500 * 2 ** attempt);
+               attempt++;
+               if (!reconnecting) appendMessage('[Disconnected, reconnecting ...]');
+               reconnecting = true;
+               setTimeout(connect, delay);
+           }};
        }}
 
 
@@ -212,7 +578,11 @@ async def get():
                e.preventDefault();
                const msg = input.value.trim();
                if (msg !== "") {{
-                   appendMessage('| ' + msg);
+                   if (ws.readyState !== WebSocket.OPEN) {{
+                       queueMessage({{ color: null, text: '[Not connected, message not sent]' }});
+                       return;
+                   }}
+                   queueMessage({{ color: null, text: '| ' + msg }});
                    ws.send(msg);
                    input.value = '';
                }}
@@ -220,6 +590,10 @@ async def get():
        }});
 
 
+       chat.addEventListener('scroll', scheduleRender, {{ passive: true }});
+       window.addEventListener('resize', rewrap);
+       document.title += ' - ' + room;
+       measure();
        connect();
    </script>
 </body>
@@ -227,136 +601,1844 @@ async def get():
 """
 
 
+# The page has no per-request input, so it is rendered and compressed once at
+# startup. Browsers revalidate on every load and get a 304 while it is unchanged.
+INDEX_PAGE = render_index_page().encode()
+INDEX_ETAG = hashlib.sha256(INDEX_PAGE).hexdigest()[:20]
+INDEX_VARIANTS = {"identity": INDEX_PAGE, "gzip": gzip.compress(INDEX_PAGE, 9, mtime=0)}
+if brotli is not None:
+   INDEX_VARIANTS["br"] = brotli.compress(INDEX_PAGE, quality=11)
+INDEX_PREFERENCE = ("br", "gzip", "identity")
+
+
+def choose_encoding(accept_encoding):
+   """
+   Picks the smallest prebuilt variant the client accepts (q > 0).
+   """
+   accepted = {}
+   for item in accept_encoding.split(","):
+       name, _, params = item.strip().partition(";")
+       q = 1.0
+       params = params.strip()
+       if params.startswith("q="):
+           try:
+               q = float(params[2:])
+           except ValueError:
+               q = 0.0
+       accepted[name.strip().lower()] = q
+   for encoding in INDEX_PREFERENCE:
+       if encoding not in INDEX_VARIANTS:
+           continue
+       q = accepted.get(encoding, accepted.get("*", 1.0 if encoding == "identity" else 0.0))
+       if q > 0:
+           return encoding
+   return "identity"
+
+
+@app.get("/")
+async def get(request: Request):
+   encoding = choose_encoding(request.headers.get("accept-encoding", ""))
+   etag = f'"{INDEX_ETAG}-{encoding}"'
+   headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+   if_none_match = request.headers.get("if-none-match", "")
+   if if_none_match.strip() == "*" or etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+       return Response(status_code=304, headers=headers)
+   if encoding != "identity":
+       headers["Content-Encoding"] = encoding
+   return Response(INDEX_VARIANTS[encoding], media_type="text/html; charset=utf-8", headers=headers)
+
+
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-   global next_user_id
-   await websocket.accept()
-   async with lock:
-       user_id = next_user_id
-       next_user_id += 1
-       color_idx = assign_color(user_id)
-       client_info[websocket] = {"id": user_id, "color_idx": color_idx}
-   clients.add(websocket)
+@app.websocket("/ws/{room}")
+async def websocket_endpoint(
+   websocket: WebSocket, room: str = DEFAULT_ROOM, last: int = None, since: int = None, batch: bool = False,
+   resume: str = None,
+):
+   """
+   Chat socket for one room, picked by path (/ws/team) or query (/ws?room=team).
+   Passing last=N or since=SEQ replays that much of the room's history in one
+   {"head", "batch"} frame and switches the socket to {"seq", "msg"} JSON frames.
+   batch=1 lets the server coalesce messages into {"batch": [...]} frames.
+   Clients offering BINARY_SUBPROTOCOL get binary packets instead of text.
+   resume=TOKEN reconnects as the session the token was issued to.
+   """
+   wants_binary = BINARY_SUBPROTOCOL in websocket.scope.get("subprotocols", ())
+   await websocket.accept(subprotocol=BINARY_SUBPROTOCOL if wants_binary else None)
+   if not ROOM_NAME.match(room):
+       await websocket.close(code=1008, reason="invalid room name")
+       return
+   if MAX_CONNECTIONS and len(sessions) >= MAX_CONNECTIONS:
+       limit_stats["connections"] += 1
+       await websocket.close(code=1013, reason="server full")
+       return
+   wants_history = last is not None or since is not None
+   wants_session = wants_binary or wants_history
+   protocol = websocket.scope["extensions"].get("chat.frame_writer")
+   session = Session(
+       websocket, room, protocol,
+       binary=wants_binary, sequenced=wants_history and not wants_binary, batched=batch and BATCH_MS > 0,
+   )
+   # Registered before the id is known, so connections waiting on the broker
+   # count against MAX_CONNECTIONS without a lock around the allocation
+   sessions[websocket] = session
+   resumed_id = verify_session(resume) if resume else None
+   try:
+       if resumed_id is not None:
+           user_id = resumed_id
+           bus.claim_user_id(user_id)
+       else:
+           user_id = await bus.allocate_user_id()
+   except ConnectionError:
+       del sessions[websocket]
+       await websocket.close(code=1013, reason="broker unavailable")
+       return
+   color_idx = assign_color(user_id)
+   session.user_id = user_id
+   session.color_idx = color_idx
+   # Sent ahead of the queue, so the watermark can neither drop nor coalesce them
+   greeting = []
+   if wants_session:
+       greeting.append(encode_session_frame(user_id, wants_binary))
+   if wants_history:
+       greeting.append(replay_frame(session, room, last, since))
+   start_writer(session, greeting)
+   watch(session)
+   rooms.setdefault(room, set()).add(session)
+   chat_stats["joins"] += 1
+
+
+   announce = resume_session(user_id, room) if resumed_id is not None else True
+   sessions_by_id[user_id] = session
+   bus.online(user_id)
+   if announce:
+       announce_presence(user_id, room, color_idx, joined=True)
+   welcome(session)
+
+
+   bucket = TokenBucket(RATE_MESSAGES, RATE_BURST) if RATE_MESSAGES > 0 else None
+   host = websocket.client.host if websocket.client else ""
+   dropped = 0  # messages over the rate limit since the last one let through
+   close_code = 1011  # unless the client disconnects first
+   try:
+       while True:
+           waiting = time.perf_counter() if tracing.SAMPLE else None
+           message = await websocket.receive()
+           trace = tracing.begin(user_id, start=waiting) if waiting else None
+           if trace:
+               trace.mark("receive")  # includes waiting for the client to send
+           if message["type"] == "websocket.disconnect":
+               raise WebSocketDisconnect(message.get("code", 1000))
+           if message.get("text") is not None:
+               texts = [message["text"]]
+           else:
+               try:
+                   texts = [text for kind, _, _, text in unpack_packets(message["bytes"]) if kind == KIND_TEXT]
+               except ValueError:
+                   await websocket.close(code=1007, reason="malformed packet")
+                   raise WebSocketDisconnect(1007)
+           chat_stats["received"] += len(texts)
+           if trace:
+               trace.mark("decode")
+           if sessions.get(websocket) is session:
+               for data in texts:
+                   limit = rate_limited(bucket, host)
+                   if limit:
+                       limit_stats[limit] += 1
+                       dropped += 1
+                       if RATE_LIMIT_CLOSE_AFTER and dropped >= RATE_LIMIT_CLOSE_AFTER:
+                           limit_stats["rate_closed"] += 1
+                           await websocket.close(code=1008, reason="rate limit exceeded")
+                           raise WebSocketDisconnect(1008)
+                       continue
+                   dropped = 0
+                   try:
+                       direct = parse_direct(data)
+                   except ValueError as e:
+                       notify(session, str(e))
+                       continue
+                   if direct is not None:
+                       send_direct(session, *direct)
+                       continue
+                   msg = f"{color_idx}:{data}"
+                   if trace:
+                       trace.mark("format")
+                   broadcast(msg, room, exclude=session, user_id=user_id, trace=trace)
+           if trace:
+               trace.end()
+   except WebSocketDisconnect as e:
+       close_code = e.code
+   finally:
+       # Also on an unexpected error, so no session outlives its connection
+       remove_client(session)
+       if sessions_by_id.get(user_id) is session:
+           del sessions_by_id[user_id]
+           bus.offline(user_id)
+           if wants_session and close_code not in FINAL_CLOSE_CODES and RESUME_GRACE > 0:
+               hold_leave(user_id, room, color_idx)
+           else:
+               announce_leave(user_id, room, color_idx)
 
 
-   join_msg = f"{color_idx}:"
-   await broadcast(join_msg, exclude=None)
+# ---------------- Shared broadcast frames ----------------
 
 
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+RSV1 = 0x40  # set on permessage-deflate compressed frames
+
+
+class FrameWriterProtocol(WebSocketsSansIOProtocol):
+   """
+   uvicorn's websocket protocol, published in the ASGI scope so client_writer()
+   can put one prebuilt frame on many transports instead of re-framing it.
+   It also offers permessage-deflate as configured by CHAT_COMPRESSION, and
+   leaves keepalive pings to the heartbeat wheel.
+   """
+   def __init__(self, *args, **kwargs):
+       super().__init__(*args, **kwargs)
+       self.last_seen = self.loop.time()  # when the client last sent anything
+       self.conn.available_extensions = server_deflate_extensions()
+       if MAX_MESSAGE_BYTES:
+           # Checked against each frame header, and the running total of a
+           # fragmented message, before any of the payload is buffered
+           self.conn.max_message_size = MAX_MESSAGE_BYTES
+
+   def data_received(self, data):
+       self.last_seen = self.loop.time()
+       super().data_received(data)
+
+   def start_keepalive(self):
+       pass  # check_heartbeats() pings instead of a ping and a pong timer here
+
+   def ping(self):
+       """Sends a keepalive ping; the pong, like any frame, refreshes last_seen."""
+       if self.close_sent or self.transport.is_closing():
+           return
+       self.pending_ping_payload = struct.pack("!I", random.getrandbits(32))
+       self.ping_sent_at = self.loop.time()
+       self.conn.send_ping(self.pending_ping_payload)
+       self.transport.write(b"".join(self.conn.data_to_send()))
+
+   def handle_parser_exception(self):
+       if isinstance(self.conn.parser_exc, PayloadTooBig):
+           limit_stats["message_size"] += 1
+       super().handle_parser_exception()
+
+   def handle_connect(self, event):
+       super().handle_connect(event)
+       scope = getattr(self, "scope", None)
+       if scope is not None:
+           scope["extensions"]["chat.frame_writer"] = self
+
+
+def encode_text_frame(message):
+   """
+   Builds an unmasked, unfragmented server-to-client text frame.
+   """
+   return encode_payload_frame(message.encode())
+
+
+def encode_payload_frame(payload, opcode=OPCODE_TEXT, compressed=False):
+   length = len(payload)
+   first = 0x80 | opcode | (RSV1 if compressed else 0)
+   if length < 126:
+       header = struct.pack("!BB", first, length)
+   elif length < 65536:
+       header = struct.pack("!BBH", first, 126, length)
+   else:
+       header = struct.pack("!BBQ", first, 127, length)
+   return header + payload
+
+
+def frame_payload(frame):
+   length = frame[1] & 0x7F
+   offset = 2 if length < 126 else 4 if length == 126 else 10
+   return frame[offset:]
+
+
+def frame_text(frame):
+   return frame_payload(frame).decode()
+
+
+async def write_frame(session, frame, messages=1):
+   """
+   Writes a prebuilt frame straight to the transport when the connection is
+   served by FrameWriterProtocol, falling back to send_text()/send_bytes() otherwise.
+   messages is how many chat messages the frame carries, for chat_stats.
+   """
+   protocol = session.protocol
+   if protocol is None:
+       if frame[0] & 0x0F == OPCODE_BINARY:
+           await session.websocket.send_bytes(frame_payload(frame))
+       else:
+           await session.websocket.send_text(frame_text(frame))
+       chat_stats["delivered"] += messages
+       return
+   deflater = session.deflater
+   if deflater is not None and not frame[0] & RSV1:
+       frame = deflater.compress_frame(frame)
+   await protocol.writable.wait()
+   if protocol.close_sent or protocol.transport.is_closing():
+       raise ConnectionError("connection is closing")
+   protocol.transport.write(frame)
+   chat_stats["delivered"] += messages
+
+
+# ---------------- Compression ----------------
+
+
+def server_deflate_extensions():
+   if COMPRESSION == "off":
+       return []
+   return [
+       ServerPerMessageDeflateFactory(
+           server_no_context_takeover=COMPRESSION == "shared",
+           server_max_window_bits=COMPRESSION_WINDOW_BITS,
+           client_max_window_bits=COMPRESSION_WINDOW_BITS,
+           compress_settings={"level": COMPRESSION_LEVEL, "memLevel": COMPRESSION_MEM_LEVEL},
+       )
+   ]
+
+
+class Deflater:
+   """
+   Server-to-client permessage-deflate as negotiated by one client. Frames
+   are written raw, bypassing the extension, so compression happens here:
+   with context takeover through the extension's own compressor, without it
+   with a fresh one per message, whose output any client can share.
+   """
+   def __init__(self, window_bits, compressor=None):
+       self.window_bits = window_bits
+       self.compressor = compressor
+
+   def compress_frame(self, frame):
+       payload = frame_payload(frame)
+       if len(payload) < COMPRESSION_MIN_BYTES:
+           return frame
+       data = deflate(payload, self.window_bits, self.compressor)
+       if self.compressor is None and len(data) >= len(payload):
+           return frame  # only safe without context takeover: the client never sees it
+       return encode_payload_frame(data, frame[0] & 0x0F, compressed=True)
+
+
+def deflate(payload, window_bits, compressor=None):
+   start = time.thread_time()
+   if compressor is None:
+       compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -window_bits, COMPRESSION_MEM_LEVEL)
+   data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+   data = data[:-4]  # RFC 7692 drops the 00 00 ff ff that ends every sync flush
+   compression_stats["cpu_seconds"] += time.thread_time() - start
+   compression_stats["frames"] += 1
+   compression_stats["bytes_in"] += len(payload)
+   compression_stats["bytes_out"] += len(data)
+   return data
+
+
+def negotiated_deflater(protocol):
+   if protocol is None or COMPRESSION == "off":
+       return None
+   for extension in protocol.conn.extensions:
+       if isinstance(extension, PerMessageDeflate):
+           if extension.local_no_context_takeover:
+               return Deflater(extension.local_max_window_bits)
+           return Deflater(extension.local_max_window_bits, extension.encoder)
+   return None
+
+
+def shared_frame(frame, deflater, cache):
+   """
+   frame as deflater's client should get it, compressed at most once per
+   broadcast and window size for every client without context takeover.
+   Context-takeover clients compress in write_frame(), in send order.
+   """
+   if deflater is None or deflater.compressor is not None:
+       return frame
+   key = (id(frame), deflater.window_bits)
+   if key not in cache:
+       cache[key] = deflater.compress_frame(frame)
+   return cache[key]
+
+
+# ---------------- Binary wire protocol ----------------
+
+
+# Packets are laid out in protocol.py; this maps them to and from the JSON
+# records sequenced text clients and the message log use
+KIND_NAMES = {  # "event" in JSON records
+   KIND_JOIN: "join", KIND_LEAVE: "leave", KIND_DIRECT: "direct", KIND_NOTICE: "notice",
+   KIND_PRESENCE: "presence",
+}
+KINDS_BY_NAME = {name: kind for kind, name in KIND_NAMES.items()}
+
+
+def message_text(message):
+   return message.partition(":")[2]
+
+
+def record_packet(record):
+   """Packet for one {"seq", "msg", "user", "event"} log record."""
+   entry = json.loads(record)
+   kind = KINDS_BY_NAME.get(entry.get("event"), KIND_TEXT)
+   return encode_packet(kind, entry.get("user", 0), entry["seq"], message_text(entry["msg"]))
+
+
+# ---------------- Per-client outbound queues ----------------
+
+
+class Session:
+   """
+   Everything kept for one connection: who it is, where it listens, how it
+   wants its frames and its outbound queue. Slotted, as a server holding
+   100k connections holds 100k of these.
+   """
+   __slots__ = (
+       "websocket", "protocol", "user_id", "color_idx", "room", "binary", "sequenced", "batched",
+       "deflater", "queue", "queued_bytes", "ready", "writer", "wheel_slot",
+   )
+
+   def __init__(self, websocket, room, protocol=None, binary=False, sequenced=False, batched=False):
+       self.websocket = websocket
+       self.protocol = protocol  # FrameWriterProtocol serving it, None falls back to send_text()
+       self.user_id = None  # until the bus hands one out
+       self.color_idx = 0
+       self.room = room
+       self.binary = binary  # negotiated BINARY_SUBPROTOCOL, gets packets in binary frames
+       self.sequenced = sequenced  # asked for history, gets {"seq", "msg"} JSON frames
+       self.batched = batched  # its queue holds batch items instead of frames
+       self.deflater = negotiated_deflater(protocol)  # for clients that negotiated permessage-deflate
+       self.queue = None  # asyncio.Queue of outbound frames while the writer runs
+       self.queued_bytes = 0  # frame bytes currently sitting in the queue
+       self.ready = None  # asyncio.Event set once BATCH_BYTES are queued, batched clients only
+       self.writer = None  # asyncio.Task draining the queue
+       self.wheel_slot = None  # its slot on the heartbeat wheel, if it is on it
+
+
+class Skipped:
+   """
+   Queue entry standing in for messages a slow client never received.
+   """
+   def __init__(self, count):
+       self.count = count
+
+   def text(self, sequenced=False):
+       if sequenced:
+           return json.dumps({"skipped": self.count})
+       return f"[{self.count} messages skipped]"
+
+   def frame(self, sequenced=False, binary=False):
+       if binary:
+           return encode_payload_frame(encode_packet(KIND_SKIPPED, 0, self.count), OPCODE_BINARY)
+       return encode_text_frame(self.text(sequenced))
+
+   def item(self, sequenced=False, binary=False):
+       """The marker as an element of a batch frame."""
+       if binary:
+           return encode_packet(KIND_SKIPPED, 0, self.count)
+       if sequenced:
+           return self.text(sequenced).encode()
+       return json.dumps(self.text()).encode()
+
+
+def start_writer(session, greeting=()):
+   """
+   Starts draining session's queue once the frames in greeting are written.
+   """
+   session.queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+   session.queued_bytes = 0
+   if session.batched:
+       session.ready = asyncio.Event()
+       writer = batch_writer(session, greeting)
+   else:
+       writer = client_writer(session, greeting)
+   session.writer = asyncio.create_task(writer)
+
+
+def stop_writer(session):
+   heartbeats.cancel(session)
+   session.queue = None
+   session.queued_bytes = 0
+   session.ready = None
+   task, session.writer = session.writer, None
+   if task is not None and task is not asyncio.current_task():
+       task.cancel()
+
+
+def send_failed(session):
+   """Removes a client whose transport refused a write."""
+   if sessions.get(session.websocket) is session:
+       chat_stats["send_failures"] += 1
+   remove_client(session)
+
+
+def remove_client(session):
+   if sessions.get(session.websocket) is session:
+       del sessions[session.websocket]
+       chat_stats["leaves"] += 1
+       members = rooms.get(session.room)
+       if members is not None:
+           members.discard(session)
+           if not members:
+               del rooms[session.room]
+   stop_writer(session)
+
+
+async def client_writer(session, greeting=()):
+   """
+   Drains one client's queue so a slow socket only ever delays itself.
+   """
+   queue = session.queue
    try:
+       for frame in greeting:
+           await write_frame(session, frame)
        while True:
-           data = await websocket.receive_text()
-           user = client_info.get(websocket)
-           if user:
-               msg = f"{user['color_idx']}:{data}"
-               await broadcast(msg, exclude=websocket)
-   except WebSocketDisconnect:
-       clients.discard(websocket)
-       user = client_info.pop(websocket, None)
-       if user:
-           leave_msg = f"{user['color_idx']}:"
-           await broadcast(leave_msg, exclude=None)
-
-
-async def broadcast(message, exclude=None):
+           frame = await queue.get()
+           if isinstance(frame, Skipped):
+               frame = frame.frame(session.sequenced, session.binary)
+           else:
+               session.queued_bytes -= len(frame)
+           await write_frame(session, frame)
+   except asyncio.CancelledError:
+       raise
+   except Exception:
+       send_failed(session)
+
+
+async def batch_writer(session, greeting=()):
+   """
+   client_writer() for ?batch=1 clients: once a message arrives, waits up to
+   BATCH_MS for more (or until BATCH_BYTES are queued) and sends everything
+   queued as {"batch": [...]} frames, or binary frames of back-to-back
+   packets, of at most BATCH_BYTES each.
+   """
+   encode = encode_packet_batch_frame if session.binary else encode_batch_frame
+   queue = session.queue
+   ready = session.ready
+   window = BATCH_MS / 1000
+   try:
+       for frame in greeting:
+           await write_frame(session, frame)
+       while True:
+           items = [await queue.get()]
+           if session.queued_bytes < BATCH_BYTES:
+               ready.clear()
+               with contextlib.suppress(asyncio.TimeoutError):
+                   await asyncio.wait_for(ready.wait(), window)
+           while not queue.empty():
+               items.append(queue.get_nowait())
+
+           batch = []
+           size = 0
+           for item in items:
+               if isinstance(item, Skipped):
+                   item = item.item(session.sequenced, session.binary)
+               else:
+                   session.queued_bytes -= len(item)
+               if batch and size + len(item) > BATCH_BYTES:
+                   await write_frame(session, encode(batch), len(batch))
+                   batch = []
+                   size = 0
+               batch.append(item)
+               size += len(item) + 1
+           if batch:
+               await write_frame(session, encode(batch), len(batch))
+   except asyncio.CancelledError:
+       raise
+   except Exception:
+       send_failed(session)
+
+
+def encode_batch_frame(items):
+   return encode_payload_frame(b'{"batch": [' + b",".join(items) + b"]}")
+
+
+def encode_packet_batch_frame(packets):
+   return encode_payload_frame(b"".join(packets), OPCODE_BINARY)
+
+
+def spawn(coroutine):
+   """Runs coroutine as a task nobody awaits, keeping it from being collected first."""
+   task = asyncio.create_task(coroutine)
+   background_tasks.add(task)
+   task.add_done_callback(background_tasks.discard)
+   return task
+
+
+async def close_slow_consumer(websocket):
+   try:
+       await asyncio.wait_for(
+           websocket.close(code=SLOW_CONSUMER_CLOSE_CODE, reason="slow consumer"),
+           SLOW_CONSUMER_CLOSE_TIMEOUT,
+       )
+   except Exception:
+       pass
+
+
+def make_room(session, size):
+   """
+   Applies the drop-oldest or coalesce policy to a client whose queue cannot
+   take size more bytes. Returns False if the new message was folded
+   into a skipped marker and must not be enqueued.
+   """
+   queue = session.queue
+   if SLOW_CONSUMER_POLICY == "drop-oldest":
+       while not queue.empty() and (
+           queue.full() or session.queued_bytes + size > SEND_QUEUE_BYTES
+       ):
+           old = queue.get_nowait()
+           if not isinstance(old, Skipped):
+               session.queued_bytes -= len(old)
+           slow_consumer_stats["dropped"] += 1
+       return True
+
+   folded = 1  # the message that did not fit
+   skipped = 0
+   while not queue.empty():
+       old = queue.get_nowait()
+       if isinstance(old, Skipped):
+           skipped += old.count
+       else:
+           folded += 1
+   session.queued_bytes = 0
+   queue.put_nowait(Skipped(skipped + folded))
+   slow_consumer_stats["coalesced"] += folded
+   return False
+
+
+def broadcast(message, room, exclude=None, kind=KIND_TEXT, user_id=0, trace=None):
+   """
+   Delivers message to room on this server and on every other node on the bus.
+   kind and user_id are only carried by binary packets and history records.
+   """
+   fan_out(message, room, exclude, kind, user_id, trace)
+   bus.publish(message, room, kind, user_id)
+   if trace:
+       trace.mark("publish")
+
+
+def encode_record(seq, message, kind, user_id):
+   record = {"seq": seq, "msg": message, "user": user_id}
+   if kind in KIND_NAMES:
+       record["event"] = KIND_NAMES[kind]
+   return json.dumps(record).encode()
+
+
+def fan_out(message, room, exclude=None, kind=KIND_TEXT, user_id=0, trace=None):
+   """
+   Records message in the room's history, encodes it into a WebSocket frame
+   once and enqueues that same buffer for every local member of room except
+   exclude, without awaiting any socket. Sequenced members share a second
+   frame carrying the sequence number, binary members a packet frame, and
+   batched members the item their writer gathers into batch frames. Frames
+   for clients without deflate context takeover are compressed once here.
+   """
+   start = time.perf_counter()
+   frame = encode_text_frame(message)
+   seq = get_history(room).append(message, len(frame), kind, user_id)
+   record = None
+   if LOG_DIR:
+       record = encode_record(seq, message, kind, user_id)
+       get_log(room).append(seq, record + b"\n")
+   if trace:
+       trace.mark("record")  # frame encoding, history and log
+   seq_frame = None
+   batch_item = None
+   packet = None
+   packet_frame = None
+   compressed = {}
+   sends = 0
    to_remove = []
-   for client in clients:
-       if client == exclude:
+   for client in rooms.get(room, ()):
+       if client is exclude:
            continue
-       try:
-           await client.send_text(message)
-       except Exception:
+       sends += 1
+       if client.binary:
+           if packet is None:
+               packet = encode_packet(kind, user_id, seq, message_text(message))
+           if client.batched:
+               item = packet
+           else:
+               if packet_frame is None:
+                   packet_frame = encode_payload_frame(packet, OPCODE_BINARY)
+               item = packet_frame
+       elif client.sequenced:
+           if record is None:
+               record = encode_record(seq, message, kind, user_id)
+           if client.batched:
+               item = record
+           else:
+               if seq_frame is None:
+                   seq_frame = encode_payload_frame(record)
+               item = seq_frame
+       elif client.batched:
+           if batch_item is None:
+               batch_item = json.dumps(message).encode()
+           item = batch_item
+       else:
+           item = frame
+       if not client.batched:
+           item = shared_frame(item, client.deflater, compressed)
+       if not enqueue(client, item):
            to_remove.append(client)
    for client in to_remove:
-       clients.discard(client)
-       client_info.pop(client, None)
+       remove_client(client)
+   if trace:
+       trace.mark("enqueue")
+   broadcast_sends.observe(sends)
+   broadcast_seconds.observe(time.perf_counter() - start)
+
+
+def enqueue(session, frame):
+   """
+   Puts frame on the session's send queue, applying SLOW_CONSUMER_POLICY when the
+   client is over its outbound watermark. Returns False if it must be removed.
+   """
+   queue = session.queue
+   if queue is None:
+       return False
+   size = len(frame)
+   if queue.full() or session.queued_bytes + size > SEND_QUEUE_BYTES:
+       if SLOW_CONSUMER_POLICY == "disconnect":
+           slow_consumer_stats["disconnected"] += 1
+           spawn(close_slow_consumer(session.websocket))
+           return False
+       if not make_room(session, size):
+           return True
+   queue.put_nowait(frame)
+   session.queued_bytes += size
+   if session.queued_bytes >= BATCH_BYTES and session.ready is not None:
+       session.ready.set()
+   return True
+
+
+# ---------------- Direct messages ----------------
+
+
+def send_direct(sender, target_id, text):
+   """
+   Delivers a /msg to target_id's session alone: one index lookup and one
+   enqueue instead of a fan-out. A target connected to another node is
+   handed to the bus; one connected nowhere is reported back at once.
+   """
+   message = f"{sender.color_idx}:{text}"
+   target = sessions_by_id.get(target_id)
+   if target is not None:
+       deliver_direct(target, message, sender.user_id)
+   elif bus.direct(message, target_id, sender.user_id):
+       direct_stats["forwarded"] += 1
+   else:
+       undeliverable(sender, target_id)
 
 
-# -------- Terminal Client -----------
+def deliver_direct(session, message, user_id):
+   if enqueue(session, single_item(session, message, KIND_DIRECT, user_id)):
+       direct_stats["delivered"] += 1
+   else:
+       remove_client(session)
 
 
-def color_message_terminal(message):
-   if ':' in message:
-       color_idx_str, text = message.split(':', 1)
-       try:
-           color_idx = int(color_idx_str)
-           color = ANSI_COLORS[color_idx % len(ANSI_COLORS)]
-           if text.strip() == "":
-               return f"{color}|{ANSI_RESET}"
-           else:
-               return f"{color}|{ANSI_RESET} {text}"
-       except:
-           pass
-   return message
+def undeliverable(session, target_id):
+   direct_stats["undeliverable"] += 1
+   notify(session, f"[user {target_id} is not connected, message not delivered]", target_id)
+
 
+def notify(session, text, user_id=0):
+   """Queues a notice for session alone; text clients get text as it is."""
+   if session is not None and not enqueue(session, single_item(session, text, KIND_NOTICE, user_id)):
+       remove_client(session)
 
-async def terminal_client(uri):
-   print(f"Connecting to server at {uri} ...")
+
+def single_item(session, message, kind, user_id):
+   """
+   What enqueue() takes to get one message to one session, in the format
+   fan_out() would pick for it but without a sequence number: direct
+   messages and notices are not part of the room's history.
+   """
+   if session.binary:
+       text = message if kind == KIND_NOTICE else message_text(message)
+       item = encode_packet(kind, user_id, 0, text)
+       return item if session.batched else encode_payload_frame(item, OPCODE_BINARY)
+   if kind == KIND_DIRECT:
+       color, _, text = message.partition(":")
+       message = f"{color}:[from {user_id}] {text}"
+   if session.sequenced:
+       item = json.dumps({"msg": message, "user": user_id, "event": KIND_NAMES[kind]}).encode()
+       return item if session.batched else shared_frame(encode_payload_frame(item), session.deflater, {})
+   if session.batched:
+       return json.dumps(message).encode()
+   return shared_frame(encode_text_frame(message), session.deflater, {})
+
+
+# ---------------- Message history ----------------
+
+
+class History:
+   """
+   Ring buffer of a room's recent broadcasts, capped by HISTORY_MESSAGES and
+   HISTORY_BYTES. Sequence numbers count every broadcast this server has
+   seen in the room, so they are only comparable on the same server.
+   """
+   def __init__(self, seq=0):
+       self.entries = collections.deque()  # (seq, message, frame size, kind, user id)
+       self.nbytes = 0
+       self.seq = seq
+
+   def append(self, message, size, kind=KIND_TEXT, user_id=0):
+       self.seq += 1
+       self.entries.append((self.seq, message, size, kind, user_id))
+       self.nbytes += size
+       while self.entries and (len(self.entries) > HISTORY_MESSAGES or self.nbytes > HISTORY_BYTES):
+           self.nbytes -= self.entries.popleft()[2]
+       return self.seq
+
+   def first_seq(self):
+       return self.entries[0][0] if self.entries else self.seq + 1
+
+   def since(self, seq):
+       start = max(seq - self.first_seq() + 1, 0)
+       return itertools.islice(self.entries, start, None)
+
+
+def get_history(room):
+   history = histories.get(room)
+   if history is None:
+       history = histories[room] = History(get_log(room).last_seq if LOG_DIR else evicted_heads.pop(room, 0))
+       while len(histories) > HISTORY_ROOMS:
+           # Only the entries go; the room's sequence carries on where it was
+           evicted, old = histories.popitem(last=False)
+           if not LOG_DIR:
+               evicted_heads[evicted] = old.seq
+   else:
+       histories.move_to_end(room)
+   return history
+
+
+def replay_frame(session, room, last=None, since=None):
+   """
+   The requested backlog for session as a single batched frame,
+   at most REPLAY_MESSAGES long; binary clients get a KIND_HEAD packet
+   followed by the backlog's packets. A since ahead of the room's head means this
+   server restarted without a log, so everything retained is sent.
+   Whatever has already left the in-memory ring is read back from the log.
+   """
+   history = get_history(room)
+   if since is not None:
+       start = since + 1 if since <= history.seq else 1
+   else:
+       start = history.seq - last + 1
+   start = max(start, history.seq - REPLAY_MESSAGES + 1, 1)
+
+   lines = b""
+   first_in_memory = history.first_seq()
+   if LOG_DIR and start < first_in_memory:
+       lines = get_log(room).read(start, first_in_memory - 1)
+       start = first_in_memory
+   entries = history.since(start - 1)
+   if session.binary:
+       packets = [encode_packet(KIND_HEAD, 0, history.seq)]
+       packets.extend(record_packet(line) for line in lines.splitlines())
+       packets.extend(
+           encode_packet(kind, user_id, seq, message_text(message))
+           for seq, message, _, kind, user_id in entries
+       )
+       return encode_payload_frame(b"".join(packets), OPCODE_BINARY)
+   batch = [encode_record(seq, message, kind, user_id) for seq, message, _, kind, user_id in entries]
+   if lines:
+       batch.insert(0, lines[:-1].replace(b"\n", b","))
+   payload = b'{"head": %d, "batch": [' % history.seq + b",".join(batch) + b"]}"
+   return encode_payload_frame(payload)
+
+
+# ---------------- Rate limits ----------------
+
+
+class TokenBucket:
+   """
+   Holds up to burst tokens and gains rate a second; take() spends one.
+   """
+   __slots__ = ("rate", "burst", "tokens", "updated")
+
+   def __init__(self, rate, burst):
+       self.rate = rate
+       self.burst = burst
+       self.tokens = float(burst)
+       self.updated = time.monotonic()
+
+   def take(self, now):
+       self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+       self.updated = now
+       if self.tokens < 1:
+           return False
+       self.tokens -= 1
+       return True
+
+
+def ip_bucket(host):
+   bucket = ip_buckets.get(host)
+   if bucket is None:
+       bucket = ip_buckets[host] = TokenBucket(IP_RATE_MESSAGES, IP_RATE_BURST)
+       while len(ip_buckets) > RATE_LIMITED_IPS:
+           ip_buckets.popitem(last=False)
+   else:
+       ip_buckets.move_to_end(host)
+   return bucket
+
+
+def rate_limited(bucket, host):
+   """
+   Spends a token for one message from a connection with this bucket and
+   client host. Returns the limit_stats key of the limit it is over, or None.
+   """
+   now = time.monotonic()
+   if bucket is not None and not bucket.take(now):
+       return "connection_rate"
+   if IP_RATE_MESSAGES > 0 and not ip_bucket(host).take(now):
+       return "ip_rate"
+   return None
+
+
+# ---------------- Sessions ----------------
+
+
+def load_session_secret():
+   secret = os.environ.get("CHAT_SESSION_SECRET")
+   if secret and not LOG_DIR and os.environ.get("CHAT_BUS", "local") == "local":
+       # Nothing remembers this process's ids, so the next one hands them out
+       # again and must not accept the tokens it signs
+       return secret.encode() + os.urandom(16)
+   if secret:
+       return secret.encode()
+   if not LOG_DIR:
+       return os.urandom(32)
+   os.makedirs(LOG_DIR, exist_ok=True)
+   path = os.path.join(LOG_DIR, "session.key")
    try:
-       async with websockets.connect(uri) as websocket:
-           user_color_idx = None
-           user_color = None
+       with open(path, "rb") as f:
+           return f.read()
+   except FileNotFoundError:
+       secret = os.urandom(32)
+       with open(path, "xb") as f:
+           f.write(secret)
+       return secret
 
 
-           print("Connected! Type messages, Ctrl+C to quit.")
+SESSION_SECRET = load_session_secret()
 
 
-           prompt_lock = threading.Lock()
+# Ids are handed out in blocks of USER_ID_BLOCK whose end is saved in
+# <LOG_DIR>/user.id, so a restarted server never hands out the id of a
+# token it signed before; over a broker the node tells it the same in HELLO
+USER_ID_BLOCK = 1000
 
 
-           async def recv():
-               nonlocal user_color_idx, user_color
-               try:
-                   async for message in websocket:
-                       if user_color_idx is None:
-                           colonPos = message.find(':')
-                           if colonPos > 0:
-                               try:
-                                   idx = int(message[:colonPos])
-                                   user_color_idx = idx
-                                   user_color = ANSI_COLORS[user_color_idx % len(ANSI_COLORS)]
-                               except:
-                                   pass
-                       with prompt_lock:
-                           print("\r" + color_message_terminal(message))
-                           if user_color:
-                               print(f"{user_color}>{ANSI_RESET} ", end="", flush=True)
-                           else:
-                               print("> ", end="", flush=True)
-               except websockets.ConnectionClosed:
-                   print("\nDisconnected from server.")
-                   return
-
-
-           recv_task = asyncio.create_task(recv())
-
-
-           loop = asyncio.get_event_loop()
-
-
-           def input_thread():
-               while True:
-                   with prompt_lock:
-                       prompt = f"{user_color}>{ANSI_RESET} " if user_color else "> "
-                   try:
-                       msg = input(prompt)
-                       asyncio.run_coroutine_threadsafe(websocket.send(msg), loop)
-                   except EOFError:
-                       break
+def restore_user_ids():
+   """Picks next_user_id up above the last saved block, if there is one."""
+   global next_user_id, reserved_user_id
+   reserved_user_id = 0
+   if LOG_DIR:
+       with contextlib.suppress(FileNotFoundError, ValueError):
+           with open(os.path.join(LOG_DIR, "user.id")) as f:
+               reserved_user_id = int(f.read())
+   next_user_id = reserved_user_id + 1
+
+
+def issued_user_id(user_id):
+   """Records user_id as taken, saving the next block first when it runs past the saved one."""
+   global next_user_id, reserved_user_id
+   next_user_id = max(next_user_id, user_id + 1)
+   if LOG_DIR and user_id > reserved_user_id:
+       reserved_user_id = user_id + USER_ID_BLOCK
+       os.makedirs(LOG_DIR, exist_ok=True)
+       path = os.path.join(LOG_DIR, "user.id")
+       with open(path + ".tmp", "w") as f:
+           f.write(str(reserved_user_id))
+           f.flush()
+           os.fsync(f.fileno())
+       os.replace(path + ".tmp", path)
 
 
-           thread = threading.Thread(target=input_thread, daemon=True)
-           thread.start()
+restore_user_ids()
 
 
-           await recv_task
-   except Exception as e:
-       print("Connection error:", e)
+def session_token(user_id):
+   signature = hmac.new(SESSION_SECRET, str(user_id).encode(), hashlib.sha256).hexdigest()[:32]
+   return f"{user_id}.{signature}"
 
 
-def run_terminal_client(ip, port):
-   uri = f"ws://{ip}:{port}/ws"
-   asyncio.run(terminal_client(uri))
+def verify_session(token):
+   """The user id token was issued to, or None if it is not one of ours."""
+   user_id, _, _ = token.partition(".")
+   if not (user_id.isascii() and user_id.isdigit()):
+       return None
+   if not hmac.compare_digest(token.encode(), session_token(int(user_id)).encode()):
+       return None
+   return int(user_id)
+
+
+def encode_session_frame(user_id, binary=False):
+   token = session_token(user_id)
+   if binary:
+       return encode_payload_frame(encode_packet(KIND_SESSION, user_id, 0, token), OPCODE_BINARY)
+   return encode_payload_frame(json.dumps({"session": token, "user": user_id}).encode())
+
+
+def resume_session(user_id, room):
+   """
+   Takes over user_id's session for a reconnecting client. Returns whether
+   its join still has to be announced: not if its leave was held back, nor
+   if this server never saw it leave (it was restarted in between).
+   """
+   bus.resumed(user_id, room)
+   old_room = take_over(user_id)
+   if old_room is not None:
+       if old_room == room:
+           return False
+       announce_leave(user_id, old_room, assign_color(user_id))
+   if user_id in announced_leaves:
+       del announced_leaves[user_id]
+       return True
+   return False
+
+
+def resumed_elsewhere(user_id, room):
+   """
+   Another node resumed user_id's session in room. Whatever is left of it
+   here is dropped; its join is announced here if its leave was.
+   """
+   old_room = take_over(user_id)
+   if old_room is not None:
+       if old_room == room:
+           return
+       announce_leave(user_id, old_room, assign_color(user_id))
+   if user_id in announced_leaves:
+       del announced_leaves[user_id]
+       announce_presence(user_id, room, assign_color(user_id), joined=True)
+
+
+def take_over(user_id):
+   """
+   Closes user_id's previous connection and cancels its held leave. Returns
+   the room it was still in, or None.
+   """
+   old_room = None
+   old = sessions_by_id.pop(user_id, None)
+   if old is not None:
+       # The old connection has not noticed it is dead yet
+       if sessions.get(old.websocket) is old:
+           old_room = old.room
+       remove_client(old)
+       spawn(old.websocket.close(code=RESUMED_CLOSE_CODE, reason="resumed elsewhere"))
+   pending = pending_leaves.pop(user_id, None)
+   if pending is not None:
+       pending[0].cancel()
+       old_room = pending[1]
+   return old_room
+
+
+# Closes after which the client is not expected back: clean ones, and the
+# server's own for malformed packets and rate limits
+FINAL_CLOSE_CODES = (1000, 1001, 1007, 1008)
+
+
+def hold_leave(user_id, room, color_idx):
+   handle = asyncio.get_running_loop().call_later(RESUME_GRACE, announce_leave, user_id, room, color_idx)
+   pending_leaves[user_id] = (handle, room, color_idx)
+
+
+def announce_leave(user_id, room, color_idx):
+   pending_leaves.pop(user_id, None)
+   announced_leaves[user_id] = None
+   announced_leaves.move_to_end(user_id)
+   while len(announced_leaves) > RECENT_LEAVES:
+       announced_leaves.popitem(last=False)
+   announce_presence(user_id, room, color_idx, joined=False)
+
+
+# ---------------- Presence ----------------
+
+
+def coalescing_presence():
+   return PRESENCE_INTERVAL > 0
+
+
+def announce_presence(user_id, room, color_idx, joined):
+   """
+   Tells room that user_id joined or left it: at once without coalescing,
+   otherwise in the room's next digest.
+   """
+   if not coalescing_presence():
+       broadcast(f"{color_idx}:", room, kind=KIND_JOIN if joined else KIND_LEAVE, user_id=user_id)
+       return
+   presence_stats["events"] += 1
+   apply_presence(room, [user_id] if joined else [], [] if joined else [user_id])
+   changes = presence_changes.setdefault(room, {})
+   if changes.get(user_id, joined) != joined:
+       # Left and came back, or came and went, since the last digest
+       del changes[user_id]
+       presence_stats["cancelled"] += 2
+   else:
+       changes[user_id] = joined
+   schedule_presence()
+
+
+def welcome(session):
+   """
+   Owes session a snapshot of who is in its room, sent with the next digest.
+   A resumed session whose join is not announced is listed all the same,
+   as this server may never have seen it before it restarted.
+   """
+   if coalescing_presence():
+       apply_presence(session.room, [session.user_id], ())
+       presence_newcomers.setdefault(session.room, set()).add(session)
+       schedule_presence()
+
+
+def schedule_presence():
+   global presence_flush
+   if presence_flush is None:
+       presence_flush = asyncio.get_running_loop().call_later(PRESENCE_INTERVAL, flush_presence)
+
+
+def stop_presence():
+   global presence_flush
+   if presence_flush is not None:
+       presence_flush.cancel()
+       presence_flush = None
+
+
+def apply_presence(room, joined, left):
+   members = presence.setdefault(room, set())
+   members.update(joined)
+   members.difference_update(left)
+   if not members:
+       del presence[room]
+
+
+def flush_presence():
+   """
+   Sends every room with changes its digest, here and to the other nodes,
+   then each newcomer its snapshot, which already includes the changes.
+   """
+   global presence_flush
+   presence_flush = None
+   start = time.perf_counter()
+   changes, newcomers = presence_changes.copy(), presence_newcomers.copy()
+   presence_changes.clear()
+   presence_newcomers.clear()
+   for room, room_changes in changes.items():
+       if not room_changes:
+           continue
+       digest = {
+           "joined": sorted(user_id for user_id, joined in room_changes.items() if joined),
+           "left": sorted(user_id for user_id, joined in room_changes.items() if not joined),
+       }
+       send_presence(room, digest, newcomers.get(room, ()))
+       bus.publish(json.dumps(digest), room, KIND_PRESENCE)
+   for room, room_newcomers in newcomers.items():
+       snapshot = {"present": sorted(presence.get(room, ()))}
+       items = {}
+       compressed = {}
+       for session in room_newcomers:
+           if sessions.get(session.websocket) is not session:
+               continue
+           presence_stats["snapshots"] += 1
+           item = shared_presence_item(session, snapshot, items, compressed)
+           if not enqueue(session, item):
+               remove_client(session)
+   presence_seconds.observe(time.perf_counter() - start)
+
+
+def receive_presence(room, message):
+   """
+   Applies a digest from another node and passes it on to local members.
+   A list of who is present there, sent by share_presence(), is only applied.
+   """
+   digest = json.loads(message)
+   if "present" in digest:
+       apply_presence(room, digest["present"], ())
+       return
+   apply_presence(room, digest.get("joined", ()), digest.get("left", ()))
+   send_presence(room, digest, presence_newcomers.get(room, ()))
+
+
+def share_presence():
+   """
+   Publishes who is in each room on this node, held leaves included, for
+   nodes that joined the bus after they arrived.
+   """
+   present = {}
+   for room, members in rooms.items():
+       present.setdefault(room, set()).update(session.user_id for session in members)
+   for user_id, (_, room, _) in pending_leaves.items():
+       present.setdefault(room, set()).add(user_id)
+   for room, user_ids in present.items():
+       bus.publish(json.dumps({"present": sorted(user_ids)}), room, KIND_PRESENCE)
+
+
+def send_presence(room, digest, exclude=()):
+   """
+   Enqueues digest for every local member of room but those in exclude,
+   encoding it once per format like fan_out() does.
+   """
+   presence_stats["digests"] += 1
+   items = {}
+   compressed = {}
+   to_remove = []
+   for client in rooms.get(room, ()):
+       if client in exclude:
+           continue
+       if not enqueue(client, shared_presence_item(client, digest, items, compressed)):
+           to_remove.append(client)
+   for client in to_remove:
+       remove_client(client)
+
+
+def shared_presence_item(session, presence, items, compressed):
+   """
+   What enqueue() takes to get a snapshot or digest to session, built once
+   per format into items: a KIND_PRESENCE packet for binary clients, a
+   {"msg", "event": "presence", ...} record for sequenced ones and the text
+   presence_text() renders for the rest. Not part of the room's history.
+   """
+   key = (session.binary, session.sequenced, session.batched)
+   item = items.get(key)
+   if item is None:
+       if session.binary:
+           item = encode_packet(KIND_PRESENCE, 0, 0, json.dumps(presence))
+           opcode = OPCODE_BINARY
+       elif session.sequenced:
+           item = json.dumps({"msg": presence_text(presence), "event": KIND_NAMES[KIND_PRESENCE], **presence}).encode()
+           opcode = OPCODE_TEXT
+       else:
+           item = json.dumps(presence_text(presence)).encode() if session.batched else presence_text(presence).encode()
+           opcode = OPCODE_TEXT
+       if not session.batched:
+           item = encode_payload_frame(item, opcode)
+       items[key] = item
+   if session.batched:
+       return item
+   return shared_frame(item, session.deflater, compressed)
+
+
+# ---------------- Heartbeats ----------------
+
+
+class TimerWheel:
+   """
+   Hashed timer wheel: entries sit in the slot of the tick they are due on
+   and advance() hands back one slot per tick, so scheduling and cancelling
+   are set operations and every connection shares one task instead of
+   owning timers. Entries keep their slot in a wheel_slot attribute.
+   Delays longer than one lap of span seconds are cut to a lap.
+   """
+   def __init__(self, tick, span):
+       self.tick = tick
+       self.slots = [set() for _ in range(max(math.ceil(span / tick), 1) + 1)]
+       self.position = 0  # the slot advance() returns next
+
+   def __len__(self):
+       return sum(len(slot) for slot in self.slots)
+
+   def schedule(self, entry, delay):
+       self.cancel(entry)
+       ticks = min(max(math.ceil(delay / self.tick), 1), len(self.slots) - 1)
+       entry.wheel_slot = (self.position + ticks) % len(self.slots)
+       self.slots[entry.wheel_slot].add(entry)
+
+   def cancel(self, entry):
+       if entry.wheel_slot is not None:
+           self.slots[entry.wheel_slot].discard(entry)
+           entry.wheel_slot = None
+
+   def advance(self):
+       """The entries due on this tick, taken off the wheel."""
+       due = self.slots[self.position]
+       self.slots[self.position] = set()
+       self.position = (self.position + 1) % len(self.slots)
+       for entry in due:
+           entry.wheel_slot = None
+       return due
+
+
+def heartbeats_enabled():
+   return HEARTBEAT_TICK > 0 and (PING_INTERVAL > 0 or IDLE_TIMEOUT > 0)
+
+
+heartbeats = TimerWheel(HEARTBEAT_TICK or 1.0, max(PING_INTERVAL, IDLE_TIMEOUT))
+
+
+def watch(session):
+   """Puts a session on the wheel, if its connection can be pinged and reaped."""
+   if session.protocol is not None and heartbeats_enabled():
+       heartbeats.schedule(session, next_heartbeat(0.0))
+
+
+def next_heartbeat(idle):
+   """Seconds until a session silent for idle seconds needs another look."""
+   delays = []
+   if PING_INTERVAL > 0:
+       delays.append(PING_INTERVAL - idle if idle < PING_INTERVAL else PING_INTERVAL)
+   if IDLE_TIMEOUT > 0:
+       delays.append(IDLE_TIMEOUT - idle)
+   return min(delays)
+
+
+def check_heartbeats(due):
+   """
+   One tick of the wheel: pings the due sessions that have gone quiet,
+   puts the live ones back and reaps those silent for IDLE_TIMEOUT together.
+   """
+   start = time.perf_counter()
+   now = asyncio.get_running_loop().time()
+   dead = []
+   for session in due:
+       idle = now - session.protocol.last_seen
+       if IDLE_TIMEOUT > 0 and idle >= IDLE_TIMEOUT:
+           dead.append(session)
+           reap_latency.observe(idle - IDLE_TIMEOUT)
+           continue
+       if PING_INTERVAL > 0 and idle >= PING_INTERVAL:
+           session.protocol.ping()
+           heartbeat_stats["pings"] += 1
+       heartbeats.schedule(session, next_heartbeat(idle))
+   for session in dead:
+       reap(session)
+   heartbeat_stats["reaped"] += len(dead)
+   heartbeat_seconds.observe(time.perf_counter() - start)
+
+
+def reap(session):
+   """Drops a dead session and announces its leave; the peer is not waited for."""
+   user_id = session.user_id
+   remove_client(session)
+   if sessions_by_id.get(user_id) is session:
+       del sessions_by_id[user_id]
+       bus.offline(user_id)
+       announce_leave(user_id, session.room, session.color_idx)
+   session.protocol.transport.abort()
+
+
+async def heartbeat_forever():
+   loop = asyncio.get_running_loop()
+   next_tick = loop.time()
+   while True:
+       next_tick += HEARTBEAT_TICK
+       # A late wakeup runs the missed ticks back to back
+       await asyncio.sleep(max(next_tick - loop.time(), 0))
+       check_heartbeats(heartbeats.advance())
+
+
+# ---------------- Persistent message log ----------------
+
+
+INDEX_ENTRY = struct.Struct("!Q")
+
+
+class MessageLog:
+   """
+   Append-only log of one room. Each segment is a pair of files named after
+   its first sequence number: <seq>.log holds one {"seq", "msg", "user"} JSON line per
+   broadcast and <seq>.idx one 8-byte offset per line.
+
+   append() only buffers; flush() hands the batch to a worker thread, which
+   is the only code that writes, one batch at a time. Everything else runs
+   on the event loop. The directory is created with the first segment.
+   """
+   def __init__(self, directory):
+       self.directory = directory
+       self.segments = sorted(
+           int(name[:-4]) for name in os.listdir(directory) if name.endswith(".log")
+       ) if os.path.isdir(directory) else []
+       self.pending = []  # (seq, line) waiting for the next flush
+       self.inflight = []  # (seq, line) being written right now
+       self.lock = asyncio.Lock()  # held from taking a batch until its thread is done
+       self.written_seq = self.recover()
+       self.last_seq = self.written_seq
+
+   def path(self, first_seq, ext):
+       return os.path.join(self.directory, f"{first_seq:020d}.{ext}")
+
+   def recover(self):
+       """
+       Trims a torn write from the newest segment and returns its last seq.
+       Lines are written before their index entries, so only the tail can
+       be inconsistent.
+       """
+       if not self.segments:
+           self.tail_first, self.tail_size = None, 0
+           return 0
+       first = self.segments[-1]
+       with open(self.path(first, "log"), "r+b") as log, open(self.path(first, "idx"), "a+b") as idx:
+           idx.seek(0)
+           offsets = idx.read()
+           count = len(offsets) // INDEX_ENTRY.size
+           end = 0
+           while count:
+               offset = INDEX_ENTRY.unpack_from(offsets, (count - 1) * INDEX_ENTRY.size)[0]
+               log.seek(offset)
+               newline = log.read().find(b"\n")
+               if newline >= 0:
+                   end = offset + newline + 1
+                   break
+               count -= 1
+           log.truncate(end)
+           idx.truncate(count * INDEX_ENTRY.size)
+       self.tail_first, self.tail_size = first, end
+       return first + count - 1
+
+   def append(self, seq, line):
+       self.pending.append((seq, line))
+       self.last_seq = seq
+
+   async def flush(self):
+       if self.idle():
+           return
+       # A cancelled caller does not stop the worker thread, so the write
+       # carries on in its own task and holds the lock until it is done
+       await asyncio.shield(self.write_pending())
+
+   def idle(self):
+       return not self.pending and not self.lock.locked()
+
+   async def write_pending(self):
+       async with self.lock:
+           if not self.pending:
+               return
+           self.inflight, self.pending = self.pending, []
+           created = await asyncio.to_thread(self.write_batch, self.inflight)
+           self.segments.extend(created)
+           self.written_seq = self.inflight[-1][0]
+           self.inflight = []
+           while len(self.segments) > max(LOG_SEGMENTS, 1):
+               first = self.segments.pop(0)
+               for ext in ("log", "idx"):
+                   with contextlib.suppress(FileNotFoundError):
+                       os.remove(self.path(first, ext))
+
+   def write_batch(self, batch):
+       """
+       Runs in a worker thread: appends batch, rotating segments as they
+       fill, and fsyncs what it wrote. Returns the segments it started.
+       """
+       created = []
+       i = 0
+       while i < len(batch):
+           if self.tail_first is None or self.tail_size >= LOG_SEGMENT_BYTES:
+               if self.tail_first is None:
+                   os.makedirs(self.directory, exist_ok=True)
+               self.tail_first, self.tail_size = batch[i][0], 0
+               created.append(self.tail_first)
+           data = []
+           offsets = []
+           while i < len(batch) and self.tail_size < LOG_SEGMENT_BYTES:
+               line = batch[i][1]
+               offsets.append(INDEX_ENTRY.pack(self.tail_size))
+               data.append(line)
+               self.tail_size += len(line)
+               i += 1
+           with open(self.path(self.tail_first, "log"), "ab") as log, \
+                open(self.path(self.tail_first, "idx"), "ab") as idx:
+               log.write(b"".join(data))
+               idx.write(b"".join(offsets))
+               log.flush()
+               idx.flush()
+               os.fsync(log.fileno())
+               os.fsync(idx.fileno())
+       return created
+
+   def read(self, first, last):
+       """
+       Newline-terminated JSON lines for seqs first..last, sliced straight out
+       of memory-mapped segments plus whatever is still waiting to be written.
+       """
+       chunks = []
+       if first <= self.written_seq and self.segments:
+           stop = min(last, self.written_seq)
+           i = max(bisect.bisect_right(self.segments, first) - 1, 0)
+           while i < len(self.segments) and self.segments[i] <= stop:
+               seg_first = self.segments[i]
+               seg_last = self.segments[i + 1] - 1 if i + 1 < len(self.segments) else self.written_seq
+               lo, hi = max(first, seg_first), min(stop, seg_last)
+               if lo <= hi:
+                   chunks.append(self.read_segment(seg_first, lo, hi))
+               i += 1
+       for seq, line in itertools.chain(self.inflight, self.pending):
+           if first <= seq <= last:
+               chunks.append(line)
+       return b"".join(chunks)
+
+   def read_segment(self, seg_first, lo, hi):
+       try:
+           with open(self.path(seg_first, "idx"), "rb") as idx_file, \
+                open(self.path(seg_first, "log"), "rb") as log_file:
+               with mmap.mmap(idx_file.fileno(), 0, access=mmap.ACCESS_READ) as idx, \
+                    mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as log:
+                   start = INDEX_ENTRY.unpack_from(idx, (lo - seg_first) * INDEX_ENTRY.size)[0]
+                   last_line = INDEX_ENTRY.unpack_from(idx, (hi - seg_first) * INDEX_ENTRY.size)[0]
+                   return log[start:log.find(b"\n", last_line) + 1]
+       except (FileNotFoundError, ValueError, struct.error):
+           return b""  # segment expired or still empty
+
+
+def get_log(room):
+   log = logs.get(room)
+   if log is None:
+       log = logs[room] = MessageLog(os.path.join(LOG_DIR, room))
+   else:
+       logs.move_to_end(room)
+   return log
+
+
+async def flush_logs():
+   for log in list(logs.values()):
+       await log.flush()
+   # Like histories, only HISTORY_ROOMS logs stay open; the least recently
+   # used are dropped once written, and get_log() reopens them from disk
+   for room in list(itertools.islice(logs, max(len(logs) - HISTORY_ROOMS, 0))):
+       if logs[room].idle():
+           del logs[room]
+
+
+async def flush_logs_forever():
+   while True:
+       await asyncio.sleep(LOG_FSYNC_INTERVAL)
+       await flush_logs()
+
+
+# ---------------- Broadcast bus ----------------
+
+
+# "local" keeps the chat inside this process; "tcp://host:port" or
+# "unix:///path" joins the other servers connected to the same broker.py
+BUS_URL = os.environ.get("CHAT_BUS", "local")
+BUS_RETRY_DELAY = 2.0
+BUS_TIMEOUT = 5.0
+
+
+class LocalBus:
+   """
+   Default bus: this process is the whole chat.
+   """
+   async def start(self):
+       pass
+
+   async def stop(self):
+       pass
+
+   async def allocate_user_id(self):
+       user_id = next_user_id
+       issued_user_id(user_id)
+       return user_id
+
+   def claim_user_id(self, user_id):
+       issued_user_id(user_id)
+
+   def publish(self, message, room, kind=KIND_TEXT, user_id=0):
+       pass
+
+   def online(self, user_id):
+       pass
+
+   def offline(self, user_id):
+       pass
+
+   def resumed(self, user_id, room):
+       pass
+
+   def direct(self, message, target_id, user_id):
+       """Hands a direct message to the node target_id is on; False if there is none."""
+       return False
+
+
+class BrokerBus:
+   """
+   Shares broadcasts and user ids with every server connected to broker.py.
+   Messages published while the broker is unreachable only reach local clients.
+   connect is a coroutine function opening a (reader, writer) stream to it.
+   """
+   def __init__(self, address, connect):
+       self.address = address
+       self.connect = connect
+       self.writer = None
+       self.pending = collections.deque()  # futures waiting for OP_ID replies
+       self.task = None
+
+   async def start(self):
+       self.task = asyncio.create_task(self.run())
+
+   async def stop(self):
+       if self.task is not None:
+           self.task.cancel()
+       if self.writer is not None:
+           self.writer.close()
+
+   async def run(self):
+       while True:
+           try:
+               reader, writer = await self.connect()
+           except OSError as e:
+               print(f"Broker {self.address} unreachable ({e}), retrying ...")
+               await asyncio.sleep(BUS_RETRY_DELAY)
+               continue
+           print(f"Connected to broker {self.address}")
+           writer.write(broker.encode_packet(broker.OP_HELLO, broker.USER_ID.pack(next_user_id - 1)))
+           # A restarted broker has to learn who is connected here again
+           for user_id in sessions_by_id:
+               writer.write(broker.encode_packet(broker.OP_ONLINE, broker.USER_ID.pack(user_id)))
+           self.writer = writer
+           if coalescing_presence():
+               # Swap presence with the nodes that were already connected
+               share_presence()
+               writer.write(broker.encode_packet(broker.OP_SYNC))
+           try:
+               await self.read_loop(reader)
+           except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+               pass
+           finally:
+               self.writer = None
+               writer.close()
+               while self.pending:
+                   future = self.pending.popleft()
+                   if not future.done():
+                       future.set_exception(ConnectionError("lost connection to broker"))
+           print("Lost connection to broker, reconnecting ...")
+           await asyncio.sleep(BUS_RETRY_DELAY)
+
+   async def read_loop(self, reader):
+       while True:
+           op, payload = await broker.read_packet(reader)
+           if op == broker.OP_PUBLISH:
+               room, message, kind, user_id = broker.unpack_publish(payload)
+               if kind == KIND_PRESENCE:
+                   receive_presence(room, message)
+               else:
+                   fan_out(message, room, kind=kind, user_id=user_id)
+           elif op == broker.OP_DIRECT:
+               message, target_id, user_id = broker.unpack_direct(payload)
+               target = sessions_by_id.get(target_id)
+               if target is not None:
+                   deliver_direct(target, message, user_id)
+           elif op == broker.OP_UNDELIVERABLE:
+               target_id, user_id = broker.DIRECT.unpack(payload)
+               undeliverable(sessions_by_id.get(user_id), target_id)
+           elif op == broker.OP_RESUMED:
+               resumed_elsewhere(*broker.unpack_resumed(payload))
+           elif op == broker.OP_SYNC:
+               if coalescing_presence():
+                   share_presence()
+           elif op == broker.OP_ID:
+               (user_id,) = broker.USER_ID.unpack(payload)
+               issued_user_id(user_id)
+               future = self.pending.popleft()
+               if not future.done():
+                   future.set_result(user_id)
+
+   async def allocate_user_id(self):
+       if self.writer is None:
+           raise ConnectionError("not connected to broker")
+       future = asyncio.get_running_loop().create_future()
+       self.pending.append(future)
+       self.writer.write(broker.encode_packet(broker.OP_ID))
+       try:
+           return await asyncio.wait_for(future, BUS_TIMEOUT)
+       except asyncio.TimeoutError:
+           raise ConnectionError("broker did not answer in time")
+
+   def claim_user_id(self, user_id):
+       """Keeps a resumed session's id from being handed out again."""
+       issued_user_id(user_id)
+       if self.writer is not None:
+           self.writer.write(broker.encode_packet(broker.OP_HELLO, broker.USER_ID.pack(user_id)))
+
+   def publish(self, message, room, kind=KIND_TEXT, user_id=0):
+       if self.writer is not None:
+           payload = broker.pack_publish(room, message, kind, user_id)
+           self.writer.write(broker.encode_packet(broker.OP_PUBLISH, payload))
+
+   def online(self, user_id):
+       if self.writer is not None:
+           self.writer.write(broker.encode_packet(broker.OP_ONLINE, broker.USER_ID.pack(user_id)))
+
+   def offline(self, user_id):
+       if self.writer is not None:
+           self.writer.write(broker.encode_packet(broker.OP_OFFLINE, broker.USER_ID.pack(user_id)))
+
+   def resumed(self, user_id, room):
+       """Tells the other nodes to drop what they still hold of user_id's session."""
+       if self.writer is not None:
+           self.writer.write(broker.encode_packet(broker.OP_RESUMED, broker.pack_resumed(user_id, room)))
+
+   def direct(self, message, target_id, user_id):
+       if self.writer is None:
+           return False
+       self.writer.write(broker.encode_packet(broker.OP_DIRECT, broker.pack_direct(message, target_id, user_id)))
+       return True
+
+
+def make_bus(url):
+   if url == "local":
+       return LocalBus()
+   if url.startswith("tcp://"):
+       address = url[len("tcp://"):]
+       host, sep, port = address.rpartition(":")
+       if not sep:
+           host, port = address, broker.DEFAULT_PORT
+       host = host or "localhost"
+       return BrokerBus(f"{host}:{port}", functools.partial(asyncio.open_connection, host, int(port)))
+   if url.startswith("unix://"):
+       path = url[len("unix://"):]
+       return BrokerBus(path, functools.partial(asyncio.open_unix_connection, path))
+   raise ValueError(f"CHAT_BUS must be 'local', 'tcp://host:port' or 'unix:///path', got {url!r}")
+
+
+bus = make_bus(BUS_URL)
+
+
+# ---------------- Metrics ----------------
+
+
+class Histogram:
+   """
+   Prometheus histogram with fixed bucket bounds; observe() is one bisect
+   and two additions, so it can sit on the broadcast path.
+   """
+   def __init__(self, bounds):
+       self.bounds = bounds
+       self.counts = [0] * (len(bounds) + 1)
+       self.sum = 0
+
+   def observe(self, value):
+       self.counts[bisect.bisect_left(self.bounds, value)] += 1
+       self.sum += value
+
+   def render(self, name, help_text):
+       lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+       total = 0
+       for bound, count in zip(self.bounds, self.counts):
+           total += count
+           lines.append(f'{name}_bucket{{le="{bound}"}} {total}')
+       total += self.counts[-1]
+       lines.append(f'{name}_bucket{{le="+Inf"}} {total}')
+       lines.append(f"{name}_sum {self.sum}")
+       lines.append(f"{name}_count {total}")
+       return lines
+
+
+broadcast_seconds = Histogram((0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0))
+broadcast_sends = Histogram((0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000))
+heartbeat_seconds = Histogram((0.00001, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0))
+reap_latency = Histogram((0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0))
+presence_seconds = Histogram((0.00001, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0))
+
+
+def metric(name, kind, help_text, samples):
+   """samples: (labels, value) pairs, labels being "" or 'key="value"'."""
+   lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+   for labels, value in samples:
+       lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+   return lines
+
+
+def render_metrics():
+   depths = [session.queue.qsize() for session in sessions.values() if session.queue is not None]
+   lines = []
+   lines += metric("chat_clients", "gauge", "Connected websocket clients.", [("", len(sessions))])
+   lines += metric("chat_rooms", "gauge", "Rooms with at least one local client.", [("", len(rooms))])
+   lines += metric("chat_joins_total", "counter", "Clients that joined.", [("", chat_stats["joins"])])
+   lines += metric("chat_leaves_total", "counter", "Clients that left or were removed.", [("", chat_stats["leaves"])])
+   lines += metric(
+       "chat_messages_received_total", "counter", "Chat messages received from clients.",
+       [("", chat_stats["received"])],
+   )
+   lines += metric(
+       "chat_messages_delivered_total", "counter", "Chat messages written to client transports.",
+       [("", chat_stats["delivered"])],
+   )
+   lines += metric(
+       "chat_send_failures_total", "counter", "Clients removed because a write to their transport failed.",
+       [("", chat_stats["send_failures"])],
+   )
+   lines += metric(
+       "chat_slow_consumer_messages_total", "counter", "Messages handled by the slow-consumer policy.",
+       [(f'action="{action}"', count) for action, count in slow_consumer_stats.items()],
+   )
+   lines += metric(
+       "chat_limit_hits_total", "counter",
+       "Messages dropped by a rate limit, connections closed for rate or size, and connections refused.",
+       [(f'limit="{limit}"', count) for limit, count in limit_stats.items()],
+   )
+   lines += metric(
+       "chat_send_queue_messages", "gauge", "Messages waiting in outbound queues.",
+       [('stat="total"', sum(depths)), ('stat="max"', max(depths, default=0))],
+   )
+   lines += metric(
+       "chat_send_queue_bytes", "gauge", "Frame bytes waiting in outbound queues.",
+       [("", sum(session.queued_bytes for session in sessions.values()))],
+   )
+   lines += metric(
+       "chat_compressed_frames_total", "counter", "Frames compressed with permessage-deflate.",
+       [("", compression_stats["frames"])],
+   )
+   lines += metric(
+       "chat_compression_bytes_total", "counter", "Payload bytes before and after compression.",
+       [('stage="in"', compression_stats["bytes_in"]), ('stage="out"', compression_stats["bytes_out"])],
+   )
+   lines += metric(
+       "chat_compression_cpu_seconds_total", "counter", "CPU time spent compressing.",
+       [("", compression_stats["cpu_seconds"])],
+   )
+   lines += broadcast_seconds.render("chat_broadcast_duration_seconds", "Time fan_out() takes per broadcast.")
+   lines += broadcast_sends.render("chat_broadcast_sends", "Clients a broadcast was queued for.")
+   lines += metric(
+       "chat_direct_messages_total", "counter",
+       "Direct messages delivered here, handed to another node, or reported undeliverable.",
+       [(f'result="{result}"', count) for result, count in direct_stats.items()],
+   )
+   lines += metric(
+       "chat_presence_events_total", "counter",
+       "Joins and leaves gathered into digests, and those that cancelled out before one was sent.",
+       [('result="gathered"', presence_stats["events"]), ('result="cancelled"', presence_stats["cancelled"])],
+   )
+   lines += metric(
+       "chat_presence_frames_total", "counter", "Presence digests fanned out to a room and snapshots sent.",
+       [('type="digest"', presence_stats["digests"]), ('type="snapshot"', presence_stats["snapshots"])],
+   )
+   lines += presence_seconds.render("chat_presence_flush_seconds", "Time one flush_presence() takes.")
+   lines += metric(
+       "chat_heartbeat_sessions", "gauge", "Sessions on the heartbeat wheel.", [("", len(heartbeats))],
+   )
+   lines += metric(
+       "chat_heartbeat_pings_total", "counter", "Keepalive pings sent to quiet clients.",
+       [("", heartbeat_stats["pings"])],
+   )
+   lines += metric(
+       "chat_heartbeat_reaped_total", "counter", "Sessions dropped after IDLE_TIMEOUT without a frame.",
+       [("", heartbeat_stats["reaped"])],
+   )
+   lines += heartbeat_seconds.render("chat_heartbeat_tick_seconds", "Time one heartbeat wheel tick takes.")
+   lines += reap_latency.render(
+       "chat_heartbeat_reap_delay_seconds", "How long past IDLE_TIMEOUT a dead session was reaped.",
+   )
+   if tracing.SAMPLE:
+       stages = sorted(tracing.stage_stats.items())
+       lines += metric(
+           "chat_trace_stage_seconds_total", "counter", "Time sampled messages spent in each stage.",
+           [(f'stage="{stage}"', total) for stage, (_, total, _) in stages],
+       )
+       lines += metric(
+           "chat_trace_stage_samples_total", "counter", "Sampled messages that went through each stage.",
+           [(f'stage="{stage}"', count) for stage, (count, _, _) in stages],
+       )
+   if tracing.LOOP_LAG_INTERVAL:
+       lines += metric(
+           "chat_loop_lag_seconds", "gauge", "How late the event loop woke up for the lag probe.",
+           [('stat="last"', tracing.loop_lag["last"]), ('stat="max"', tracing.loop_lag["max"])],
+       )
+   return "\n".join(lines) + "\n"
+
+
+@app.get("/metrics")
+async def metrics():
+   return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 def is_port_in_use(port):
@@ -390,61 +2472,198 @@ def choose_port(default_port=8000):
            return port, False
 
 
-def input_ip_port_or_password():
+# ---------------- Prefork workers ----------------
+
+
+# A worker that exits within WORKER_MIN_LIFETIME seconds of starting is taken
+# to have failed at startup, and the server shuts down instead of restarting it
+WORKER_MIN_LIFETIME = 5.0
+
+
+def server_config(host, port, log_level="info"):
+   return uvicorn.Config(
+       app=app, host=host, port=port, log_level=log_level,
+       ws=FrameWriterProtocol, ws_per_message_deflate=COMPRESSION != "off",
+   )
+
+
+def listen_reuseport(host, port, backlog):
+   family = socket.AF_INET6 if ":" in host else socket.AF_INET
+   sock = socket.socket(family, socket.SOCK_STREAM)
+   sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+   sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+   sock.bind((host, port))
+   sock.listen(backlog)
+   return sock
+
+
+def run_worker(index, host, port, relay_path):
    """
-   Prompts the user to enter either a password (encoded IP+port) or IP and port manually.
+   Body of one forked worker: its own event loop and listening socket, and
+   the relay as its bus.
    """
-   inp = input("Enter connection password (encoded IP+port) OR IP (e.g. 192.168.x.x or localhost): ").strip()
-   if not inp:
-       inp = "localhost"
-   # Check if looks like password (alphanumeric, short)
-   if all(c in ALPHABET for c in inp.lower()) and len(inp) <= 12:
-       # Try decode password
-       try:
-           ip, port = decode_ip_port(inp)
-           print(f"Decoded password to IP: {ip}, port: {port}")
-           return ip, port
-       except Exception:
-           print("Invalid password format, please enter IP and port manually.")
-   # Not a valid password, ask for port manually
-   ip = inp
-   port_str = input("Enter server port (default 8000): ").strip()
-   port = 8000
-   if port_str.isdigit():
-       port = int(port_str)
-   return ip, port
+   global LOG_DIR, bus
+   if relay_path is not None:
+       bus = make_bus(f"unix://{relay_path}")
+   if LOG_DIR:
+       LOG_DIR = os.path.join(LOG_DIR, f"worker-{index}")  # a log has one writer
+       restore_user_ids()
+   root, ext = os.path.splitext(tracing.TRACE_FILE)
+   tracing.TRACE_FILE = f"{root}-{index}{ext}"
+   config = server_config(host, port, log_level="warning")
+   sock = listen_reuseport(host, port, config.backlog)
+   asyncio.run(uvicorn.Server(config).serve(sockets=[sock]))
+
+
+def run_relay(sock):
+   async def serve():
+       server = await asyncio.start_unix_server(broker.Broker().handle_node, sock=sock)
+       async with server:
+           await server.serve_forever()
+
+   asyncio.run(serve())
+
+
+def fork(target, *args):
+   """Runs target(*args) in a forked child and returns its pid."""
+   pid = os.fork()
+   if pid:
+       return pid
+   signal.signal(signal.SIGTERM, signal.SIG_DFL)
+   code = 0
+   try:
+       target(*args)
+   except KeyboardInterrupt:
+       pass
+   except SystemExit as e:
+       code = e.code if isinstance(e.code, int) else 1
+   except BaseException:
+       traceback.print_exc()
+       code = 1
+   sys.stdout.flush()
+   sys.stderr.flush()
+   os._exit(code)
+
+
+def run_workers(count, host, port):
+   """
+   Headless prefork server. Each of count workers accepts on host:port through
+   its own SO_REUSEPORT socket, so the kernel spreads connections over them and
+   each runs its event loop on its own core. Workers share rooms, broadcasts and
+   user ids through a broker.py relay on a Unix socket, run by one more child,
+   or through CHAT_BUS when that already names a broker. Workers that crash
+   are restarted.
+   """
+   if not hasattr(socket, "SO_REUSEPORT") or not hasattr(os, "fork"):
+       raise SystemExit("--workers needs fork() and SO_REUSEPORT, which this platform lacks")
+   if is_port_in_use(port):
+       raise SystemExit(f"Port {port} is already in use.")
+   children = {}  # pid -> (worker index, or None for the relay, and start time)
+   relay_dir = relay_path = None
+   if BUS_URL == "local":
+       relay_dir = tempfile.mkdtemp(prefix="chat-relay-")
+       relay_path = os.path.join(relay_dir, "relay.sock")
+       relay_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+       relay_sock.bind(relay_path)
+       relay_sock.listen(count)  # workers can connect before the relay's loop runs
+       children[fork(run_relay, relay_sock)] = (None, time.monotonic())
+       relay_sock.close()
+
+
+   def start_worker(index):
+       children[fork(run_worker, index, host, port, relay_path)] = (index, time.monotonic())
+
+
+   for index in range(count):
+       start_worker(index)
+   print(f"{count} workers serving on {host}:{port}, bus: {f'unix://{relay_path}' if relay_path else BUS_URL}")
+   signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+   try:
+       while True:
+           pid, status = os.wait()
+           index, started = children.pop(pid)
+           code = os.waitstatus_to_exitcode(status)
+           if index is None:
+               print(f"Relay exited with {code}, shutting down")
+               break
+           if time.monotonic() - started < WORKER_MIN_LIFETIME:
+               print(f"Worker {index} exited with {code} while starting, shutting down")
+               break
+           print(f"Worker {index} exited with {code}, restarting it")
+           start_worker(index)
+   except KeyboardInterrupt:
+       pass
+   finally:
+       # Workers first, so they do not see the relay go away while closing
+       for relay in (False, True):
+           pids = [pid for pid, (index, _) in children.items() if (index is None) == relay]
+           for pid in pids:
+               with contextlib.suppress(ProcessLookupError):
+                   os.kill(pid, signal.SIGTERM)
+           for pid in pids:
+               with contextlib.suppress(ChildProcessError):
+                   os.waitpid(pid, 0)
+       if relay_dir is not None:
+           shutil.rmtree(relay_dir, ignore_errors=True)
+
+
+def run_headless(workers, host, port):
+   if workers > 1:
+       run_workers(workers, host, port)
+   else:
+       asyncio.run(uvicorn.Server(server_config(host, port)).serve())
 
 
 # -------------- Main logic with fixed concurrency ----------------
 
 
+class ReadyServer(uvicorn.Server):
+   """
+   uvicorn.Server that sets ready once it is listening, so the embedded
+   terminal client connects as soon as it can instead of after a fixed wait.
+   """
+   def __init__(self, config):
+       super().__init__(config)
+       self.ready = asyncio.Event()
+
+   async def startup(self, sockets=None):
+       await super().startup(sockets)
+       if self.started:
+           self.ready.set()
+
+
 async def main():
    port, join_as_client = choose_port(8000)
+   room = choose_room()
    ip = get_local_ip()
    if join_as_client:
        print(f"Joining existing chat on localhost:{port} ...")
-       await terminal_client(f"ws://localhost:{port}/ws")
+       await terminal_client(chat_uri("localhost", port, room))
        return
 
 
    password = encode_ip_port(ip, port)
    print(f"\nServer starting on {ip}:{port} ...")
    print(f"Share this connection password with others to join:\n  {password}")
-   print(f"Clients can connect via ws://{ip}:{port}/ws or open http://{ip}:{port}/ in browser")
-   print(f"Run 'python {sys.argv[0]} --terminal' to start terminal client and join chat\n")
+   print(f"Clients can connect via ws://{ip}:{port}/ws/<room> or open http://{ip}:{port}/?room=<room> in browser")
+   print(f"Run 'python {sys.argv[0]} --terminal' to start terminal client and join chat")
+   print(f"Broadcast bus: {BUS_URL}\n")
 
 
-   config = uvicorn.Config(app=app, host="0.0.0.0", port=port, log_level="info")
-   server = uvicorn.Server(config)
+   server = ReadyServer(server_config("0.0.0.0", port))
 
 
    server_task = asyncio.create_task(server.serve())
-   # Wait a moment for server to start
-   await asyncio.sleep(1)
+   ready_task = asyncio.create_task(server.ready.wait())
+   await asyncio.wait((server_task, ready_task), return_when=asyncio.FIRST_COMPLETED)
+   if server_task.done():
+       ready_task.cancel()
+       await server_task  # startup failed, e.g. the port was taken meanwhile
+       return
 
 
    # Run terminal client in same event loop
-   await terminal_client(f"ws://{ip}:{port}/ws")
+   await terminal_client(chat_uri(ip, port, room))
 
 
    # Wait for server task (runs forever)
@@ -452,10 +2671,16 @@ async def main():
 
 
 if __name__ == "__main__":
-   if len(sys.argv) > 1 and sys.argv[1].lower() == "--terminal":
-       ip, port = input_ip_port_or_password()
-       asyncio.run(terminal_client(f"ws://{ip}:{port}/ws"))
+   # --terminal was handled before the imports
+   if len(sys.argv) > 1:
+       parser = argparse.ArgumentParser(description="Run the chat server headless, without prompts or a terminal client.")
+       parser.add_argument("--workers", type=int, default=1, help="processes sharing the port with SO_REUSEPORT")
+       parser.add_argument("--host", default="0.0.0.0")
+       parser.add_argument("--port", type=int, default=8000)
+       args = parser.parse_args()
+       run_headless(args.workers, args.host, args.port)
    else:
+       clear_screen()
        asyncio.run(main())
 
 
@@ -0,0 +1,403 @@
+"""
+Terminal chat client.
+
+   python terminal.py              (or: python server.py --terminal)
+
+Asks for the server's connection password or address and a room, then chats
+from the terminal. It needs only the websockets package: none of the web
+stack server.py loads is imported on this path.
+"""
+import asyncio
+import json
+import os
+import random
+import sys
+
+import websockets
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory
+
+from protocol import (
+    ALPHABET,
+    ANSI_COLORS,
+    ANSI_RESET,
+    BINARY_SUBPROTOCOL,
+    COMPRESSION,
+    COMPRESSION_LEVEL,
+    COMPRESSION_MEM_LEVEL,
+    COMPRESSION_WINDOW_BITS,
+    DEFAULT_ROOM,
+    DIRECT_COMMAND,
+    KIND_DIRECT,
+    KIND_JOIN,
+    KIND_LEAVE,
+    KIND_NOTICE,
+    KIND_PRESENCE,
+    KIND_SESSION,
+    KIND_SKIPPED,
+    KIND_TEXT,
+    NO_RECONNECT_CODES,
+    ROOM_NAME,
+    assign_color,
+    decode_ip_port,
+    presence_text,
+    unpack_packets,
+)
+
+
+# The renderer redraws at most TERMINAL_RENDER_FPS times a second and keeps
+# at most TERMINAL_MAX_PENDING_LINES between redraws; typed messages wait in
+# a queue of TERMINAL_SEND_QUEUE_SIZE, after which reading stdin pauses.
+TERMINAL_RENDER_FPS = 20
+TERMINAL_MAX_PENDING_LINES = 2000
+TERMINAL_SEND_QUEUE_SIZE = 64
+
+# Reconnect delays are drawn uniformly from 0 up to an exponentially growing
+# ceiling (full jitter), so clients dropped together do not return together
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+
+COLOR_PREFIXES = [f"{color}|{ANSI_RESET} " for color in ANSI_COLORS]
+BLANK_PREFIXES = [f"{color}|{ANSI_RESET}" for color in ANSI_COLORS]
+PROMPTS = [f"{color}>{ANSI_RESET} " for color in ANSI_COLORS]
+
+def clear_screen():
+    """Clears the terminal with ANSI escapes instead of running cls or clear."""
+    if not sys.stdout.isatty():
+        return
+    if os.name == "nt":
+        enable_virtual_terminal()
+    sys.stdout.write("\033[2J\033[3J\033[H")
+    sys.stdout.flush()
+
+
+def enable_virtual_terminal():
+    # Windows consoles only interpret escapes in virtual terminal mode, which
+    # running cls used to switch on as a side effect
+    import ctypes
+    kernel32 = ctypes.windll.kernel32
+    handle = kernel32.GetStdHandle(-11)  # STD_OUTPUT_HANDLE
+    mode = ctypes.c_uint32()
+    if kernel32.GetConsoleMode(handle, ctypes.byref(mode)):
+        kernel32.SetConsoleMode(handle, mode.value | 0x0004)  # ENABLE_VIRTUAL_TERMINAL_PROCESSING
+
+
+def client_deflate_extensions():
+    if COMPRESSION == "off":
+        return []
+    return [
+        ClientPerMessageDeflateFactory(
+            client_max_window_bits=COMPRESSION_WINDOW_BITS,
+            compress_settings={"level": COMPRESSION_LEVEL, "memLevel": COMPRESSION_MEM_LEVEL},
+        )
+    ]
+
+
+def color_message_terminal(message):
+    color_idx_str, colon, text = message.partition(':')
+    if colon and color_idx_str.isdigit():
+        color_idx = int(color_idx_str) % len(ANSI_COLORS)
+        if text.strip() == "":
+            return BLANK_PREFIXES[color_idx]
+        return COLOR_PREFIXES[color_idx] + text
+    return message
+
+
+class TerminalRenderer:
+    """
+    Collects incoming lines and writes them, followed by the prompt, in one
+    go per redraw, so a flood costs a few large writes instead of one write
+    and flush per message.
+    """
+    def __init__(self):
+        self.lines = []
+        self.skipped = 0
+        self.prompt = "> "
+        self.dirty = asyncio.Event()
+
+    def add(self, line):
+        self.lines.append(line)
+        if len(self.lines) > TERMINAL_MAX_PENDING_LINES:
+            drop = len(self.lines) - TERMINAL_MAX_PENDING_LINES
+            del self.lines[:drop]
+            self.skipped += drop
+        self.dirty.set()
+
+    def flush(self):
+        if not self.lines and not self.skipped:
+            return
+        out = ["\r\033[K"]
+        if self.skipped:
+            out.append(f"[{self.skipped} lines skipped]\n")
+            self.skipped = 0
+        out.append("\n".join(self.lines))
+        out.append("\n")
+        out.append(self.prompt)
+        self.lines = []
+        sys.stdout.write("".join(out))
+        sys.stdout.flush()
+
+    async def run(self):
+        try:
+            while True:
+                await self.dirty.wait()
+                self.dirty.clear()
+                self.flush()
+                await asyncio.sleep(1 / TERMINAL_RENDER_FPS)
+        finally:
+            self.flush()
+
+
+async def stdin_lines():
+    """
+    Yields lines typed on stdin. The fd is watched by the event loop where
+    that is possible; Windows consoles cannot be, so there each line is read
+    in the default executor instead.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        fd = sys.stdin.fileno()
+        ready = asyncio.Event()
+        loop.add_reader(fd, ready.set)
+    except (NotImplementedError, ValueError, OSError):
+        while True:
+            line = await loop.run_in_executor(None, sys.stdin.readline)
+            if not line:
+                return
+            yield line.rstrip("\r\n")
+    try:
+        pending = b""
+        while True:
+            await ready.wait()
+            ready.clear()
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                if pending:
+                    yield pending.decode(errors="replace")
+                return
+            *lines, pending = (pending + chunk).split(b"\n")
+            for line in lines:
+                yield line.decode(errors="replace").rstrip("\r")
+    finally:
+        loop.remove_reader(fd)
+
+
+PACKET_MESSAGES = {KIND_JOIN: "[user {} joined]", KIND_LEAVE: "[user {} left]"}
+UNSEQUENCED_KINDS = (KIND_SKIPPED, KIND_DIRECT, KIND_NOTICE, KIND_PRESENCE)  # their seq is not a position in the room
+
+
+def packet_messages(packets):
+    messages = []
+    for kind, user_id, seq, text in packets:
+        if kind == KIND_SKIPPED:
+            messages.append(f"[{seq} messages skipped]")
+        elif kind == KIND_NOTICE:
+            messages.append(text)
+        elif kind == KIND_PRESENCE:
+            messages.append(presence_text(json.loads(text)))
+        elif kind == KIND_TEXT:
+            messages.append(f"{assign_color(user_id)}:{text}")
+        elif kind == KIND_DIRECT:
+            messages.append(f"{assign_color(user_id)}:[from {user_id}] {text}")
+        elif kind in PACKET_MESSAGES:
+            messages.append(f"{assign_color(user_id)}:{PACKET_MESSAGES[kind].format(user_id)}")
+    return messages
+
+
+def unpack_messages(message):
+    """
+    Splits a {"batch": [...]} frame or a binary frame of packets into
+    "idx:text" messages; other text frames are one message.
+    """
+    if isinstance(message, bytes):
+        return packet_messages(unpack_packets(message))
+    if message.startswith("{"):
+        try:
+            frame = json.loads(message)
+        except ValueError:
+            return [message]
+        if isinstance(frame, dict) and isinstance(frame.get("batch"), list):
+            messages = []
+            for item in frame["batch"]:
+                if isinstance(item, str):
+                    messages.append(item)
+                elif "skipped" in item:
+                    messages.append(f"[{item['skipped']} messages skipped]")
+                else:
+                    messages.append(item.get("msg", ""))
+            return messages
+    return [message]
+
+
+def reconnect_delay(attempt):
+    return random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** attempt))
+
+
+class TerminalSession:
+    """
+    What the terminal client keeps across reconnects: the resume token and
+    the last sequence number it has seen.
+    """
+    def __init__(self):
+        self.token = None
+        self.user_id = None
+        self.last_seq = None
+
+    def uri(self, uri):
+        params = []
+        if self.token is not None:
+            params.append(f"resume={self.token}")
+        if self.last_seq is not None:
+            params.append(f"since={self.last_seq}")
+        if not params:
+            return uri
+        return uri + ("&" if "?" in uri else "?") + "&".join(params)
+
+    def messages(self, frame):
+        if not isinstance(frame, bytes):
+            return unpack_messages(frame)
+        packets = unpack_packets(frame)
+        for kind, user_id, seq, text in packets:
+            if kind == KIND_SESSION:
+                self.token = text
+                self.user_id = user_id
+            elif kind not in UNSEQUENCED_KINDS:
+                self.last_seq = seq
+        return packet_messages(packets)
+
+
+async def run_terminal_connection(websocket, renderer, outbound, session):
+    """
+    Shows what arrives on websocket and sends what is typed until it closes.
+    Returns whether anything arrived.
+    """
+    async def send():
+        while True:
+            msg = await outbound.get()
+            try:
+                await websocket.send(msg)
+            except websockets.ConnectionClosed as e:
+                renderer.add(f"[Not sent, connection closed: {e}]")
+                return
+
+    send_task = asyncio.create_task(send())
+    received = False
+    try:
+        async for frame in websocket:
+            received = True
+            messages = session.messages(frame)
+            if session.user_id is not None:
+                renderer.prompt = PROMPTS[assign_color(session.user_id)]
+            for message in messages:
+                renderer.add(color_message_terminal(message))
+    except websockets.ConnectionClosed:
+        pass
+    finally:
+        send_task.cancel()
+    return received
+
+
+async def terminal_client(uri):
+    """
+    Chats on uri from the terminal, reconnecting with jittered exponential
+    backoff and resuming the same session whenever the connection drops.
+    """
+    print(f"Connecting to server at {uri} ...")
+    renderer = TerminalRenderer()
+    outbound = asyncio.Queue(maxsize=TERMINAL_SEND_QUEUE_SIZE)
+    session = TerminalSession()
+
+
+    async def read_input():
+        async for line in stdin_lines():
+            if line.strip():
+                await outbound.put(line)
+
+
+    tasks = [asyncio.create_task(renderer.run()), asyncio.create_task(read_input())]
+    attempt = 0
+    try:
+        while True:
+            code = None
+            try:
+                async with websockets.connect(
+                    session.uri(uri), subprotocols=[BINARY_SUBPROTOCOL],
+                    compression=None, extensions=client_deflate_extensions(),
+                ) as websocket:
+                    if session.token is None:
+                        renderer.add(
+                            f"Connected! Type messages, {DIRECT_COMMAND} <user id> <text> to message one user,"
+                            " Ctrl+C to quit."
+                        )
+                    else:
+                        renderer.add("Reconnected.")
+                    if await run_terminal_connection(websocket, renderer, outbound, session):
+                        attempt = 0
+                code = websocket.close_code
+            except (OSError, asyncio.TimeoutError, websockets.InvalidHandshake) as e:
+                renderer.add(f"Connection error: {e}")
+            if code in NO_RECONNECT_CODES:
+                renderer.add(f"Server closed the connection: {websocket.close_reason}")
+                return
+            delay = reconnect_delay(attempt)
+            attempt += 1
+            renderer.add(f"Disconnected from server, reconnecting in {delay:.1f}s ...")
+            await asyncio.sleep(delay)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def chat_uri(ip, port, room=DEFAULT_ROOM):
+    return f"ws://{ip}:{port}/ws/{room}?batch=1"
+
+
+def run_terminal_client(ip, port, room=DEFAULT_ROOM):
+    uri = chat_uri(ip, port, room)
+    asyncio.run(terminal_client(uri))
+
+
+def choose_room(default_room=DEFAULT_ROOM):
+    while True:
+        room = input(f"Enter room to join (default {default_room}): ").strip()
+        if room == "":
+            return default_room
+        if ROOM_NAME.match(room):
+            return room
+        print("Room names are 1-64 letters, digits, '-' or '_'.")
+
+
+def input_ip_port_or_password():
+    """
+    Prompts the user to enter either a password (encoded IP+port) or IP and port manually,
+    then the room to join.
+    """
+    inp = input("Enter connection password (encoded IP+port) OR IP (e.g. 192.168.x.x or localhost): ").strip()
+    if not inp:
+        inp = "localhost"
+    # Check if looks like password (alphanumeric, short)
+    if all(c in ALPHABET for c in inp.lower()) and len(inp) <= 12:
+        # Try decode password
+        try:
+            ip, port = decode_ip_port(inp)
+            print(f"Decoded password to IP: {ip}, port: {port}")
+            return ip, port, choose_room()
+        except Exception:
+            print("Invalid password format, please enter IP and port manually.")
+    # Not a valid password, ask for port manually
+    ip = inp
+    port_str = input("Enter server port (default 8000): ").strip()
+    port = 8000
+    if port_str.isdigit():
+        port = int(port_str)
+    return ip, port, choose_room()
+
+
+def main():
+    clear_screen()
+    ip, port, room = input_ip_port_or_password()
+    asyncio.run(terminal_client(chat_uri(ip, port, room)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Opt-in hot-path tracing for the chat servers.
+
+   CHAT_TRACE_SAMPLE=0.01 CHAT_LOOP_LAG_INTERVAL=0.1 python server.py
+
+A sampled fraction of received messages is timed stage by stage (receive,
+decode, format, encrypt, fan-out, ...) and an optional monitor measures how
+late the event loop wakes up. Both are kept in a bounded ring of Chrome
+trace events, written to CHAT_TRACE_FILE on SIGUSR1 and at shutdown; open
+the file in chrome://tracing or https://ui.perfetto.dev.
+"""
+import asyncio
+import collections
+import json
+import os
+import random
+import signal
+import threading
+import time
+
+
+SAMPLE = float(os.environ.get("CHAT_TRACE_SAMPLE", "0"))  # fraction of messages traced, 0 = off
+TRACE_FILE = os.environ.get("CHAT_TRACE_FILE", "chat-trace.json")
+MAX_EVENTS = int(os.environ.get("CHAT_TRACE_EVENTS", "100000"))  # newest events kept for the dump
+LOOP_LAG_INTERVAL = float(os.environ.get("CHAT_LOOP_LAG_INTERVAL", "0"))  # seconds between probes, 0 = off
+
+PID = os.getpid()
+
+events = collections.deque(maxlen=MAX_EVENTS)
+stage_stats = {}  # stage -> [count, total seconds, max seconds], sampled messages only
+loop_lag = {"last": 0.0, "max": 0.0, "probes": 0}
+monitor_task = None
+
+
+def enabled():
+    return SAMPLE > 0 or LOOP_LAG_INTERVAL > 0
+
+
+class Trace:
+    """
+    Stage timings of one sampled message. Every mark() closes the stage that
+    started at the previous mark; end() records them all.
+    """
+    __slots__ = ("tid", "name", "last", "stages")
+
+    def __init__(self, tid, name, start=None):
+        self.tid = tid
+        self.name = name
+        self.last = time.perf_counter() if start is None else start
+        self.stages = []  # (stage, start, end)
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages.append((stage, self.last, now))
+        self.last = now
+
+    def end(self):
+        if not self.stages:
+            return
+        first = self.stages[0][1]
+        events.append(span(self.name, first, self.last - first, self.tid))
+        for stage, start, stop in self.stages:
+            events.append(span(stage, start, stop - start, self.tid))
+            stats = stage_stats.setdefault(stage, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += stop - start
+            stats[2] = max(stats[2], stop - start)
+
+
+def begin(tid, name="message", start=None):
+    """
+    A Trace for this message if it is sampled, else None. start lets the
+    first stage begin before the call, e.g. when the receive was awaited.
+    """
+    if SAMPLE and random.random() < SAMPLE:
+        return Trace(tid, name, start)
+    return None
+
+
+def span(name, start, duration, tid):
+    return {"name": name, "ph": "X", "ts": start * 1e6, "dur": duration * 1e6, "pid": PID, "tid": tid}
+
+
+async def monitor_loop_lag():
+    """
+    Sleeps LOOP_LAG_INTERVAL at a time and records how much later than
+    asked the loop woke up: time other callbacks held it.
+    """
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(time.perf_counter() - start - LOOP_LAG_INTERVAL, 0.0)
+        loop_lag["last"] = lag
+        loop_lag["max"] = max(loop_lag["max"], lag)
+        loop_lag["probes"] += 1
+        events.append({"name": "loop lag", "ph": "C", "ts": time.perf_counter() * 1e6, "pid": PID, "args": {"ms": lag * 1000}})
+
+
+def dump(path=None):
+    path = path or TRACE_FILE
+    trace = {"traceEvents": list(events), "displayTimeUnit": "ms"}
+    with open(path, "w") as f:
+        json.dump(trace, f)
+    print(f"Wrote {len(trace['traceEvents'])} trace events to {path}")
+
+
+async def dump_async(path=None):
+    await asyncio.to_thread(dump, path)
+
+
+def handles_signals():
+    # Only the main thread can take signals; serv.py runs uvicorn in another one
+    return hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread()
+
+
+def start():
+    """
+    Starts the loop-lag monitor and the SIGUSR1 dump handler, if tracing is on.
+    Call from the server's startup, inside its event loop. Off the main
+    thread there is no handler, and the trace is only dumped at shutdown.
+    """
+    global monitor_task
+    if not enabled():
+        return
+    if LOOP_LAG_INTERVAL > 0:
+        monitor_task = asyncio.create_task(monitor_loop_lag())
+    if handles_signals():
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGUSR1, lambda: asyncio.ensure_future(dump_async()))
+
+
+async def stop():
+    global monitor_task
+    if not enabled():
+        return
+    if monitor_task is not None:
+        monitor_task.cancel()
+        monitor_task = None
+    if handles_signals():
+        asyncio.get_running_loop().remove_signal_handler(signal.SIGUSR1)
+    await dump_async()